@@ -2,6 +2,11 @@
 
 from aimage.head import *
 from aimage.img import *
+from aimage.probe import *
+from aimage.color_adjust import *
+from aimage.shard import *
+from aimage.augment import *
+from aimage.annotation_index import *
 from aimage.ui import *
 from aimage.stub_data_loader_od import *
 from aimage.stub_data_loader import *
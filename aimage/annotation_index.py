@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+import concurrent.futures
+import glob
+import json
+import os
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+# Detection annotations compiled once into columnar arrays, loaded back with np.load(mmap_mode="r").
+#  - <path>/meta.json         format, class names and image_root.
+#  - <path>/paths.bin         image paths relative to image_root, utf-8, back to back.
+#  - <path>/path_offsets.npy  (N + 1, ) int64 byte offsets into paths.bin.
+#  - <path>/sizes.npy         (N, 2) int32 image (width, height) from the annotations.
+#  - <path>/box_offsets.npy   (N + 1, ) int64, the boxes of image i are rows box_offsets[i]:box_offsets[i + 1].
+#  - <path>/boxes.npy         (M, 4) float32 [x1, y1, x2, y2] in image pixels.
+#  - <path>/class_ids.npy     (M, ) int32 index into the class names.
+
+
+def _write(path, fmt, classes, image_root, rel_paths, sizes, counts, boxes, class_ids):
+    os.makedirs(path, exist_ok=True)
+    blobs = [p.encode("utf-8") for p in rel_paths]
+    path_offsets = np.zeros((len(blobs) + 1, ), dtype=np.int64)
+    np.cumsum([len(b) for b in blobs], out=path_offsets[1:])
+    with open(os.path.join(path, "paths.bin"), "wb") as fp:
+        fp.write(b"".join(blobs))
+    box_offsets = np.zeros((len(counts) + 1, ), dtype=np.int64)
+    np.cumsum(counts, out=box_offsets[1:])
+    np.save(os.path.join(path, "path_offsets.npy"), path_offsets)
+    np.save(os.path.join(path, "sizes.npy"), np.asarray(sizes, dtype=np.int32).reshape(-1, 2))
+    np.save(os.path.join(path, "box_offsets.npy"), box_offsets)
+    np.save(os.path.join(path, "boxes.npy"), np.asarray(boxes, dtype=np.float32).reshape(-1, 4))
+    np.save(os.path.join(path, "class_ids.npy"), np.asarray(class_ids, dtype=np.int32).reshape(-1))
+    with open(os.path.join(path, "meta.json"), "w") as fp:
+        json.dump({"format": fmt, "classes": classes, "image_root": os.path.abspath(image_root)}, fp)
+    return path
+
+
+def compile_coco(json_path, image_dir, path, skip_crowd=True):  # @public
+    # COCO instances json -> annotation index. Category ids are renumbered 0.. in category id order.
+    with open(json_path) as fp:
+        coco = json.load(fp)
+    cats = sorted(coco.get("categories", []), key=lambda c: c["id"])
+    cat_index = {c["id"]: i for i, c in enumerate(cats)}
+    images = coco["images"]
+    image_index = {im["id"]: i for i, im in enumerate(images)}
+    anns = [a for a in coco.get("annotations", []) if not (skip_crowd and a.get("iscrowd", 0))]
+    coco = None
+    owner = np.array([image_index[a["image_id"]] for a in anns], dtype=np.int64)
+    xywh = np.array([a["bbox"] for a in anns], dtype=np.float32).reshape(-1, 4)
+    cids = np.array([cat_index[a["category_id"]] for a in anns], dtype=np.int32)
+    anns = None
+    order = np.argsort(owner, kind="stable")
+    boxes = xywh[order]
+    boxes[:, 2:4] += boxes[:, 0:2]
+    counts = np.bincount(owner, minlength=len(images))
+    return _write(path, "coco", [c["name"] for c in cats], image_dir, [im["file_name"] for im in images], [(im.get("width", 0), im.get("height", 0)) for im in images], counts, boxes,
+                  cids[order])
+
+
+def _parse_voc(xml_path, skip_difficult):
+    root = ET.parse(xml_path).getroot()
+    size = root.find("size")
+    wh = (int(float(size.findtext("width", "0"))), int(float(size.findtext("height", "0")))) if size is not None else (0, 0)
+    objects = []
+    for obj in root.iter("object"):
+        if skip_difficult and obj.findtext("difficult", "0").strip() == "1":
+            continue
+        bb = obj.find("bndbox")
+        box = [float(bb.findtext(k)) for k in ("xmin", "ymin", "xmax", "ymax")]
+        objects.append((obj.findtext("name").strip(), box))
+    return root.findtext("filename"), wh, objects
+
+
+def compile_voc(voc_root, path, image_set=None, classes=None, skip_difficult=False, workers=None):  # @public
+    # Pascal VOC layout (Annotations/*.xml, JPEGImages/) -> annotation index.
+    # image_set: name of ImageSets/Main/<image_set>.txt to restrict the images. classes: names in index order (default: sorted).
+    if image_set is not None:
+        with open(os.path.join(voc_root, "ImageSets", "Main", image_set + ".txt")) as fp:
+            xml_paths = [os.path.join(voc_root, "Annotations", line.split()[0] + ".xml") for line in fp if line.strip()]
+    else:
+        xml_paths = sorted(glob.glob(os.path.join(voc_root, "Annotations", "*.xml")))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        parsed = list(executor.map(lambda p: _parse_voc(p, skip_difficult), xml_paths))
+    if classes is None:
+        classes = sorted({name for f, wh, objects in parsed for name, box in objects})
+    class_index = {name: i for i, name in enumerate(classes)}
+    boxes = [box for f, wh, objects in parsed for name, box in objects]
+    class_ids = [class_index[name] for f, wh, objects in parsed for name, box in objects]
+    return _write(path, "voc", list(classes), os.path.join(voc_root, "JPEGImages"), [f for f, wh, objects in parsed], [wh for f, wh, objects in parsed], [len(objects) for f, wh, objects in parsed],
+                  boxes, class_ids)
+
+
+class AnnotationIndex:
+    # Read side. Nothing is materialized per image: paths and boxes are sliced out of memory maps on demand.
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as fp:
+            meta = json.load(fp)
+        self.format = meta["format"]
+        self.class_names = meta["classes"]
+        self.classes = {name: {"index": i} for i, name in enumerate(self.class_names)}
+        self.image_root = meta["image_root"]
+        self.paths_blob = np.memmap(os.path.join(path, "paths.bin"), dtype=np.uint8, mode="r") if os.path.getsize(os.path.join(path, "paths.bin")) else np.zeros((0, ), dtype=np.uint8)
+        self.path_offsets = np.load(os.path.join(path, "path_offsets.npy"), mmap_mode="r")
+        self.sizes = np.load(os.path.join(path, "sizes.npy"), mmap_mode="r")
+        self.box_offsets = np.load(os.path.join(path, "box_offsets.npy"), mmap_mode="r")
+        self.boxes = np.load(os.path.join(path, "boxes.npy"), mmap_mode="r")
+        self.class_ids = np.load(os.path.join(path, "class_ids.npy"), mmap_mode="r")
+
+    def __len__(self):
+        return len(self.path_offsets) - 1
+
+    def file_path(self, i):
+        rel = bytes(self.paths_blob[self.path_offsets[i]:self.path_offsets[i + 1]]).decode("utf-8")
+        return os.path.join(self.image_root, rel)
+
+    def box_rows(self, i):
+        # (K, 5) float32 [x1, y1, x2, y2, class_id], the rows form of bounding_box_table.
+        s, e = self.box_offsets[i], self.box_offsets[i + 1]
+        rows = np.empty((e - s, 5), dtype=np.float32)
+        rows[:, 0:4] = self.boxes[s:e]
+        rows[:, 4] = self.class_ids[s:e]
+        return rows
+
+    def sample(self, i):
+        # The dict AggressiveImageGeneratorForOD takes in `datas`.
+        return {"file_path": self.file_path(i), "bounding_box_table": self.box_rows(i)}
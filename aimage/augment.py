@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+import math
+
+import cv2
+import numpy as np
+from aimage.img import _is_rgb
+
+# CPU implementation of the make_full_aug_params() keys.
+# Augmenter works in place on a NHWC uint8 block (a loader chunk). Per pixel operations are array ops
+# over every selected sample at once (flips, HSV, tone curves, noise, mixup), all geometric operations
+# of a sample are folded into a single warp, and only filters and erase rectangles loop per sample.
+# random_* values are probabilities per sample, the other keys are the ranges used when they fire.
+
+AUG_DEFAULTS = {
+    "random_gaussian": 0,
+    "random_sharp": 0,
+    "random_median": 0,
+    "random_bilateral": 0,
+    "random_mosaic": 0,
+    "mosaic_shift_range": 1,
+    "random_equalization": 0,
+    "random_color_reduction": 0,
+    "random_cos": 0,
+    "random_hsv": 0,
+    "hue_range": 15,
+    "saturation_range": 0.05,
+    "lightness_range": 0.1,
+    "random_pow": 0,
+    "pow_min": 0.9,
+    "pow_max": 1.3,
+    "random_horizontal_flip": 0,
+    "random_vertical_flip": 0,
+    "random_shuffle_splitted_images": 0,
+    "random_resize_and_arrange_images": 0,
+    "random_crop": 0,
+    "crop_range": 0.2,
+    "random_noise": 0,
+    "random_erase": 0,
+    "background_type": 5,
+    "affine_transform": 0,
+    "aggressive_transform": 0,
+    "random_x_shift": 0.1,
+    "random_y_shift": 0.1,
+    "random_x_scaling_range": 0.1,
+    "random_y_scaling_range": 0.1,
+    "random_x_rotate_range": 10,
+    "random_y_rotate_range": 10,
+    "random_z_rotate_range": 10,
+    "random_distortion": 0,
+    "random_mixup": 0,
+    "mixup_alpha": 0.1,
+}
+
+_PROBABILITIES = [k for k in AUG_DEFAULTS if k.startswith("random_") and k.endswith("_range") is False and k not in ("random_x_shift", "random_y_shift")] + ["affine_transform", "aggressive_transform"]
+
+_IDENTITY = np.arange(256, dtype=np.float32)
+
+
+class Augmenter:
+    def __init__(self, params=None, color_order=None):
+        # params: data_aug_params. Values may be strings, unknown keys are ignored.
+        self.p = dict(AUG_DEFAULTS)
+        for k in params or {}:
+            if k in AUG_DEFAULTS:
+                self.p[k] = float(params[k])
+        self.color_order = color_order
+        self.active = any(self.p[k] > 0 for k in _PROBABILITIES)
+
+    def pick(self, rng, n, key):
+        p = self.p[key]
+        if p <= 0:
+            return np.zeros((0, ), dtype=np.int64)
+        return np.flatnonzero(rng.random(n) < p)
+
+    def __call__(self, images, rng):
+        # Returns the mixup table (N, 2) float32 of [partner index in block, weight], partner -1 for unmixed samples, or None.
+        if self.active is False or len(images) == 0:
+            return None
+        self.geometry(images, rng)
+        self.flip(images, rng)
+        self.hsv(images, rng)
+        self.tone(images, rng)
+        self.equalize(images, rng)
+        self.filters(images, rng)
+        self.noise(images, rng)
+        self.erase(images, rng)
+        return self.mixup(images, rng)
+
+    # Geometry: crop, affine and perspective become one 3x3 matrix per sample.
+    def geometry(self, images, rng):
+        n, h, w = images.shape[0:3]
+        crop = rng.random(n) < self.p["random_crop"]
+        affine = rng.random(n) < self.p["affine_transform"]
+        aggressive = rng.random(n) < self.p["aggressive_transform"]
+        for i in np.flatnonzero(crop | affine | aggressive):
+            m = np.eye(3)
+            if aggressive[i]:
+                m = self.perspective_matrix(rng, w, h) @ m
+            if affine[i]:
+                m = self.affine_matrix(rng, w, h) @ m
+            if crop[i]:
+                m = self.crop_matrix(rng, w, h) @ m
+            images[i] = cv2.warpPerspective(images[i], m, (w, h), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REFLECT_101).reshape(images[i].shape)
+        for i in self.pick(rng, n, "random_distortion"):
+            self.distort(images, i, rng)
+        for i in self.pick(rng, n, "random_shuffle_splitted_images"):
+            self.shuffle_split(images, i, rng)
+        for i in self.pick(rng, n, "random_resize_and_arrange_images"):
+            self.arrange(images, i, rng)
+
+    def crop_matrix(self, rng, w, h):
+        # Random window of (1 - crop_range .. 1) of each side, stretched back to the full size.
+        r = self.p["crop_range"]
+        cw = w * (1 - rng.uniform(0, r))
+        ch = h * (1 - rng.uniform(0, r))
+        x0 = rng.uniform(0, w - cw)
+        y0 = rng.uniform(0, h - ch)
+        return np.array([[w / cw, 0, -x0 * w / cw], [0, h / ch, -y0 * h / ch], [0, 0, 1]])
+
+    def affine_matrix(self, rng, w, h):
+        p = self.p
+        sx = 1 + rng.uniform(-p["random_x_scaling_range"], p["random_x_scaling_range"])
+        sy = 1 + rng.uniform(-p["random_y_scaling_range"], p["random_y_scaling_range"])
+        a = math.radians(rng.uniform(-p["random_z_rotate_range"], p["random_z_rotate_range"]))
+        tx = rng.uniform(-p["random_x_shift"], p["random_x_shift"]) * w
+        ty = rng.uniform(-p["random_y_shift"], p["random_y_shift"]) * h
+        cx = w / 2
+        cy = h / 2
+        c = math.cos(a)
+        s = math.sin(a)
+        rs = np.array([[c * sx, -s * sy], [s * sx, c * sy]])
+        t = np.array([cx + tx, cy + ty]) - rs @ np.array([cx, cy])
+        return np.array([[rs[0, 0], rs[0, 1], t[0]], [rs[1, 0], rs[1, 1], t[1]], [0, 0, 1]])
+
+    def perspective_matrix(self, rng, w, h):
+        # Rotation of the image plane around the x and y axes, seen by a pinhole camera of focal max(w, h).
+        p = self.p
+        ax = math.radians(rng.uniform(-p["random_x_rotate_range"], p["random_x_rotate_range"]))
+        ay = math.radians(rng.uniform(-p["random_y_rotate_range"], p["random_y_rotate_range"]))
+        rx = np.array([[1, 0, 0], [0, math.cos(ax), -math.sin(ax)], [0, math.sin(ax), math.cos(ax)]])
+        ry = np.array([[math.cos(ay), 0, math.sin(ay)], [0, 1, 0], [-math.sin(ay), 0, math.cos(ay)]])
+        f = max(w, h)
+        k = np.array([[f, 0, w / 2], [0, f, h / 2], [0, 0, 1]])
+        return k @ ry @ rx @ np.linalg.inv(k)
+
+    def distort(self, images, i, rng):
+        # Smooth random displacement field, upsampled from a 4x4 grid.
+        h, w = images.shape[1:3]
+        amp = 0.03 * max(w, h)
+        grid = rng.uniform(-amp, amp, (2, 4, 4)).astype(np.float32)
+        dx = cv2.resize(grid[0], (w, h), interpolation=cv2.INTER_CUBIC)
+        dy = cv2.resize(grid[1], (w, h), interpolation=cv2.INTER_CUBIC)
+        xs, ys = np.meshgrid(np.arange(w, dtype=np.float32), np.arange(h, dtype=np.float32))
+        images[i] = cv2.remap(images[i], xs + dx, ys + dy, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REFLECT_101).reshape(images[i].shape)
+
+    def shuffle_split(self, images, i, rng):
+        # Swap the quadrants of the image.
+        h, w = images.shape[1:3]
+        h2 = h // 2
+        w2 = w // 2
+        tiles = [images[i, y:y + h2, x:x + w2].copy() for y in (0, h2) for x in (0, w2)]
+        order = rng.permutation(4)
+        for k, (y, x) in enumerate([(y, x) for y in (0, h2) for x in (0, w2)]):
+            images[i, y:y + h2, x:x + w2] = tiles[order[k]]
+
+    def arrange(self, images, i, rng):
+        # The image shrunk to 1/2 or 1/3 and tiled over itself.
+        h, w = images.shape[1:3]
+        k = int(rng.integers(2, 4))
+        small = cv2.resize(images[i], (-(-w // k), -(-h // k)), interpolation=cv2.INTER_AREA)
+        if small.ndim == 2:
+            small = small[:, :, None]
+        images[i] = np.tile(small, (k, k, 1))[0:h, 0:w]
+
+    def flip(self, images, rng):
+        n = len(images)
+        idx = self.pick(rng, n, "random_horizontal_flip")
+        if len(idx):
+            images[idx] = images[idx, :, ::-1]
+        idx = self.pick(rng, n, "random_vertical_flip")
+        if len(idx):
+            images[idx] = images[idx, ::-1]
+
+    def hsv(self, images, rng):
+        idx = self.pick(rng, len(images), "random_hsv")
+        if len(idx) == 0 or images.shape[3] != 3:
+            return
+        p = self.p
+        n, h, w, c = images[idx].shape
+        rgb = _is_rgb(self.color_order)
+        hsv = cv2.cvtColor(images[idx].reshape(n * h, w, c), cv2.COLOR_RGB2HSV if rgb else cv2.COLOR_BGR2HSV).reshape(n, h, w, c)
+        # hue_range is in degrees, OpenCV hue in 2 degree units.
+        dh = np.round(rng.uniform(-p["hue_range"], p["hue_range"], n) / 2).astype(np.int16)
+        gs = (1 + rng.uniform(-p["saturation_range"], p["saturation_range"], n)).astype(np.float32)
+        gv = (1 + rng.uniform(-p["lightness_range"], p["lightness_range"], n)).astype(np.float32)
+        hsv[..., 0] = np.mod(hsv[..., 0].astype(np.int16) + dh[:, None, None], 180)
+        hsv[..., 1] = np.clip(hsv[..., 1] * gs[:, None, None], 0, 255)
+        hsv[..., 2] = np.clip(hsv[..., 2] * gv[:, None, None], 0, 255)
+        images[idx] = cv2.cvtColor(hsv.reshape(n * h, w, c), cv2.COLOR_HSV2RGB if rgb else cv2.COLOR_HSV2BGR).reshape(n, h, w, c)
+
+    def tone(self, images, rng):
+        # pow -> cos -> color reduction composed into one table per sample and applied with a single gather.
+        n = len(images)
+        luts = np.tile(_IDENTITY, (n, 1))
+        idx = self.pick(rng, n, "random_pow")
+        if len(idx):
+            g = rng.uniform(self.p["pow_min"], self.p["pow_max"], len(idx)).astype(np.float32)
+            luts[idx] = np.power(luts[idx] / 255.0, g[:, None]) * 255.0
+        idx = self.pick(rng, n, "random_cos")
+        if len(idx):
+            t = rng.uniform(0, 1, len(idx)).astype(np.float32)[:, None]
+            x = luts[idx]
+            luts[idx] = (1 - t) * x + t * (1 - np.cos(np.pi * x / 255.0)) * 127.5
+        idx = self.pick(rng, n, "random_color_reduction")
+        if len(idx):
+            step = np.left_shift(1, rng.integers(2, 6, len(idx))).astype(np.float32)[:, None]
+            luts[idx] = np.floor(luts[idx] / step) * step
+        changed = np.flatnonzero(np.any(luts != _IDENTITY, axis=1))
+        if len(changed) == 0:
+            return
+        luts = np.clip(np.round(luts[changed]), 0, 255).astype(np.uint8)
+        images[changed] = luts[np.arange(len(changed))[:, None, None, None], images[changed]]
+
+    def equalize(self, images, rng):
+        rgb = _is_rgb(self.color_order)
+        for i in self.pick(rng, len(images), "random_equalization"):
+            if images.shape[3] == 3:
+                # Luma only, so the colors stay.
+                ycc = cv2.cvtColor(images[i], cv2.COLOR_RGB2YCrCb if rgb else cv2.COLOR_BGR2YCrCb)
+                ycc[..., 0] = cv2.equalizeHist(np.ascontiguousarray(ycc[..., 0]))
+                images[i] = cv2.cvtColor(ycc, cv2.COLOR_YCrCb2RGB if rgb else cv2.COLOR_YCrCb2BGR)
+            else:
+                images[i, ..., 0] = cv2.equalizeHist(np.ascontiguousarray(images[i, ..., 0]))
+
+    def filters(self, images, rng):
+        n, h, w = images.shape[0:3]
+        for i in self.pick(rng, n, "random_gaussian"):
+            k = int(rng.choice((3, 5)))
+            images[i] = cv2.GaussianBlur(images[i], (k, k), 0).reshape(images[i].shape)
+        for i in self.pick(rng, n, "random_sharp"):
+            a = rng.uniform(0.5, 1.5)
+            kernel = np.array([[0, -a, 0], [-a, 1 + 4 * a, -a], [0, -a, 0]], dtype=np.float32)
+            images[i] = cv2.filter2D(images[i], -1, kernel).reshape(images[i].shape)
+        for i in self.pick(rng, n, "random_median"):
+            images[i] = cv2.medianBlur(images[i], 3).reshape(images[i].shape)
+        for i in self.pick(rng, n, "random_bilateral"):
+            images[i] = cv2.bilateralFilter(images[i], 5, 50, 50).reshape(images[i].shape)
+        for i in self.pick(rng, n, "random_mosaic"):
+            # Pixelation with a random block size, the grid is shifted by up to mosaic_shift_range blocks.
+            b = int(rng.integers(2, 9))
+            s = int(rng.integers(0, int(b * self.p["mosaic_shift_range"]) + 1))
+            img = np.roll(images[i], (s, s), axis=(0, 1))
+            small = cv2.resize(img, (-(-w // b), -(-h // b)), interpolation=cv2.INTER_AREA)
+            img = cv2.resize(small, (w, h), interpolation=cv2.INTER_NEAREST).reshape(images[i].shape)
+            images[i] = np.roll(img, (-s, -s), axis=(0, 1))
+
+    def noise(self, images, rng):
+        idx = self.pick(rng, len(images), "random_noise")
+        if len(idx) == 0:
+            return
+        sigma = rng.uniform(2, 20, len(idx)).astype(np.float32)
+        noise = rng.standard_normal(images[idx].shape, dtype=np.float32) * sigma[:, None, None, None]
+        images[idx] = np.clip(images[idx] + noise, 0, 255).astype(np.uint8)
+
+    def erase(self, images, rng):
+        # background_type: 0 black, 1 white, 2 gray, 3 random color, 4 random noise, 5 any of them.
+        n, h, w, c = images.shape
+        for i in self.pick(rng, n, "random_erase"):
+            ew = max(1, int(w * rng.uniform(0.1, 0.4)))
+            eh = max(1, int(h * rng.uniform(0.1, 0.4)))
+            x = int(rng.integers(0, w - ew + 1))
+            y = int(rng.integers(0, h - eh + 1))
+            t = int(self.p["background_type"])
+            if t >= 5:
+                t = int(rng.integers(0, 5))
+            if t == 0:
+                images[i, y:y + eh, x:x + ew] = 0
+            elif t == 1:
+                images[i, y:y + eh, x:x + ew] = 255
+            elif t == 2:
+                images[i, y:y + eh, x:x + ew] = 128
+            elif t == 3:
+                images[i, y:y + eh, x:x + ew] = rng.integers(0, 256, c, dtype=np.uint8)
+            else:
+                images[i, y:y + eh, x:x + ew] = rng.integers(0, 256, (eh, ew, c), dtype=np.uint8)
+
+    def mixup(self, images, rng):
+        n = len(images)
+        idx = self.pick(rng, n, "random_mixup")
+        if len(idx) == 0 or n < 2:
+            return None
+        partner = (idx + rng.integers(1, n, len(idx))) % n
+        alpha = max(self.p["mixup_alpha"], 1e-3)
+        lam = rng.beta(alpha, alpha, len(idx)).astype(np.float32)
+        lam = np.maximum(lam, 1 - lam)
+        mixed = images[idx] * lam[:, None, None, None] + images[partner] * (1 - lam[:, None, None, None])
+        images[idx] = np.clip(mixed + 0.5, 0, 255).astype(np.uint8)
+        mix = np.full((n, 2), -1, dtype=np.float32)
+        mix[:, 1] = 1
+        mix[idx, 0] = partner
+        mix[idx, 1] = lam
+        return mix
+
+
+def mix_signals(signals, mix):  # @public
+    # Applies an Augmenter mixup table to the (N, C) signals of the same block.
+    if mix is None:
+        return signals
+    signals = np.asarray(signals, dtype=np.float32)
+    out = signals.copy()
+    i = np.flatnonzero(mix[:, 0] >= 0)
+    j = mix[i, 0].astype(np.int64)
+    lam = mix[i, 1:2]
+    out[i] = signals[i] * lam + signals[j] * (1 - lam)
+    return out
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+import functools
+
+import cv2
+import numpy as np
+from aimage.img import _is_rgb
+
+# Every adjustment is a uint8 lookup table memoized on its parameters, so the
+# per-frame cost is one cv2.LUT pass (plus one HSV round trip for hue/saturation/value).
+# Images may be a single HWC image or a whole NHWC batch.
+
+LUT_CACHE_SIZE = 1024
+
+
+def _readonly(lut):
+    lut.flags.writeable = False
+    return lut
+
+
+@functools.lru_cache(maxsize=LUT_CACHE_SIZE)
+def gamma_lut(g):  # @public
+    x = np.arange(256, dtype=np.float64) / 255.0
+    return _readonly(np.clip(np.power(x, g) * 255.0, 0, 255).astype(np.uint8))
+
+
+@functools.lru_cache(maxsize=LUT_CACHE_SIZE)
+def contrast_lut(c):  # @public
+    x = np.arange(256, dtype=np.float64)
+    return _readonly(np.clip((x - 128.0) * c + 128.0, 0, 255).astype(np.uint8))
+
+
+@functools.lru_cache(maxsize=LUT_CACHE_SIZE)
+def brightness_lut(b):  # @public
+    x = np.arange(256, dtype=np.float64)
+    return _readonly(np.clip(x + b, 0, 255).astype(np.uint8))
+
+
+@functools.lru_cache(maxsize=LUT_CACHE_SIZE)
+def tone_lut(gamma=1.0, contrast=1.0, brightness=0):  # @public
+    # gamma -> contrast -> brightness folded into a single table.
+    lut = gamma_lut(gamma)
+    lut = contrast_lut(contrast)[lut]
+    lut = brightness_lut(brightness)[lut]
+    return _readonly(lut)
+
+
+@functools.lru_cache(maxsize=LUT_CACHE_SIZE)
+def hsv_lut(h=0, s=0, v=0, s_gain=1.0, v_gain=1.0):  # @public
+    # 3 channel table for OpenCV uint8 HSV. Hue is in OpenCV units (0-179) and wraps, saturation/value saturate.
+    x = np.arange(256, dtype=np.float64)
+    lut = np.empty((256, 1, 3), dtype=np.uint8)
+    hue = x.copy()
+    hue[0:180] = np.mod(x[0:180] + h, 180)
+    lut[:, 0, 0] = hue.astype(np.uint8)
+    lut[:, 0, 1] = np.clip(x * s_gain + s, 0, 255).astype(np.uint8)
+    lut[:, 0, 2] = np.clip(x * v_gain + v, 0, 255).astype(np.uint8)
+    return _readonly(lut)
+
+
+def _flat(img):
+    # NHWC -> (N*H, W, C) so a single OpenCV call covers the batch.
+    if isinstance(img, np.ndarray) is False: raise Exception("img must be numpy.")
+    if img.dtype != np.uint8: raise Exception("img dtype must be np.uint8.")
+    if img.ndim <= 3:
+        return img
+    return np.ascontiguousarray(img).reshape(-1, img.shape[-2], img.shape[-1])
+
+
+def apply_lut(img, lut):  # @public
+    return cv2.LUT(_flat(img), lut).reshape(img.shape)
+
+
+def apply_hsv_lut(img, lut, color_order=None):  # @public
+    if img.shape[-1] != 3: raise Exception("img channel must be 3.")
+    rgb = _is_rgb(color_order)
+    hsv = cv2.cvtColor(_flat(img), cv2.COLOR_RGB2HSV if rgb else cv2.COLOR_BGR2HSV)
+    cv2.LUT(hsv, lut, dst=hsv)
+    cv2.cvtColor(hsv, cv2.COLOR_HSV2RGB if rgb else cv2.COLOR_HSV2BGR, dst=hsv)
+    return hsv.reshape(img.shape)
+
+
+def adjust_gamma(img, g):  # @public
+    return apply_lut(img, gamma_lut(float(g)))
+
+
+def adjust_contrast(img, c):  # @public
+    return apply_lut(img, contrast_lut(float(c)))
+
+
+def adjust_brightness(img, b):  # @public
+    return apply_lut(img, brightness_lut(float(b)))
+
+
+def adjust_tone(img, gamma=1.0, contrast=1.0, brightness=0):  # @public
+    return apply_lut(img, tone_lut(float(gamma), float(contrast), float(brightness)))
+
+
+def adjust_hsv(img, h=0, s=0, v=0, s_gain=1.0, v_gain=1.0, color_order=None):  # @public
+    return apply_hsv_lut(img, hsv_lut(float(h), float(s), float(v), float(s_gain), float(v_gain)), color_order)
+
+
+def adjust_hue(img, h, color_order=None):  # @public
+    return adjust_hsv(img, h=h, color_order=color_order)
+
+
+def adjust_saturation(img, gain, color_order=None):  # @public
+    return adjust_hsv(img, s_gain=gain, color_order=color_order)
+
+
+def adjust_value(img, gain, color_order=None):  # @public
+    return adjust_hsv(img, v_gain=gain, color_order=color_order)
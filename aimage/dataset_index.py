@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+import concurrent.futures
+import json
+import os
+import sqlite3
+import time
+
+import numpy as np
+from aimage.img import is_image_ext
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: no flock, shared_scan() scans without the lock.
+    fcntl = None
+
+
+class DatasetIndex:
+    # Persistent listing of an `entry` directory tree.
+    #  - <index_path>              sqlite: directories (mtime, subdirectories) and files (size, mtime).
+    #  - <index_path>.signals.npy  class-signal matrix per directory (D x C), rows are gathered by file_dirs.
+    # scan() revalidates with one stat per directory and only lists directories whose mtime changed.
+    # The top-level (class) directories are walked in parallel with os.scandir, which is latency bound on network filesystems.
+    # index_path=None keeps the index in memory.
+    def __init__(self, entry, index_path=None, accept=is_image_ext, workers=None):
+        self.entry = entry
+        self.index_path = index_path
+        self.accept = accept
+        self.workers = workers
+        self.dirs = []
+        self.files = []
+        self.file_dirs = np.zeros((0, ), dtype=np.int32)
+        self.sizes = np.zeros((0, ), dtype=np.int64)
+        self.mtimes = np.zeros((0, ), dtype=np.int64)
+        self.rescanned = []
+        self.db = sqlite3.connect(index_path if index_path else ":memory:", check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime_ns INTEGER, subdirs TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS files (dir TEXT, name TEXT, size INTEGER, mtime_ns INTEGER, PRIMARY KEY (dir, name))")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        # A listing made with another file filter is useless, start over.
+        accept_name = "%s.%s" % (accept.__module__, accept.__qualname__)
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'accept'").fetchone()
+        if row is None or row[0] != accept_name:
+            self.db.execute("DELETE FROM dirs")
+            self.db.execute("DELETE FROM files")
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('accept', ?)", (accept_name, ))
+            self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def path(self, i):
+        d = self.dirs[self.file_dirs[i]]
+        return os.path.join(self.entry, d, self.files[i]) if d else os.path.join(self.entry, self.files[i])
+
+    def paths(self):
+        return [self.path(i) for i in range(len(self.files))]
+
+    def list_dir(self, rel):
+        subdirs = []
+        files = []
+        with os.scandir(os.path.join(self.entry, rel)) as it:
+            for e in it:
+                # Symlinked directories are not followed (like pathlib's "**"), so link cycles cannot loop the walk.
+                if e.is_dir(follow_symlinks=False):
+                    subdirs.append(e.name)
+                elif self.accept(e.name) and e.is_file():
+                    st = e.stat()
+                    files.append((rel, e.name, st.st_size, st.st_mtime_ns))
+        return sorted(subdirs), files
+
+    def store_dir(self, rel, mtime_ns, subdirs, files):
+        self.db.execute("DELETE FROM files WHERE dir = ?", (rel, ))
+        self.db.executemany("INSERT INTO files VALUES (?, ?, ?, ?)", files)
+        self.db.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)", (rel, mtime_ns, json.dumps(subdirs)))
+
+    def visit(self, rel, known):
+        # (rel, mtime_ns, subdirs, files) of one directory. files is None when the stored listing is still valid.
+        try:
+            mtime_ns = os.stat(os.path.join(self.entry, rel)).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        k = known.get(rel)
+        if k is not None and k[0] == mtime_ns:
+            return (rel, mtime_ns, json.loads(k[1]), None)
+        subdirs, files = self.list_dir(rel)
+        return (rel, mtime_ns, subdirs, files)
+
+    def walk(self, rel, known):
+        # Visits a subtree. Runs on a scan thread, so it only reads `known` and never touches the database.
+        visited = []
+        stack = [rel]
+        while stack:
+            v = self.visit(stack.pop(), known)
+            if v is None:
+                continue
+            visited.append(v)
+            for sd in v[2]:
+                stack.append(os.path.join(v[0], sd) if v[0] else sd)
+        return visited
+
+    def scan(self):
+        known = {}
+        for rel, mtime_ns, subdirs in self.db.execute("SELECT path, mtime_ns, subdirs FROM dirs"):
+            known[rel] = (mtime_ns, subdirs)
+        visited = []
+        root = self.visit("", known)
+        if root is not None:
+            visited.append(root)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="aimage-scan") as executor:
+                for part in executor.map(lambda sd: self.walk(sd, known), root[2]):
+                    visited += part
+        seen = set()
+        self.rescanned = []
+        for rel, mtime_ns, subdirs, files in visited:
+            seen.add(rel)
+            if files is not None:
+                self.store_dir(rel, mtime_ns, subdirs, files)
+                self.rescanned.append(rel)
+        for rel in known:
+            if rel not in seen:
+                self.db.execute("DELETE FROM dirs WHERE path = ?", (rel, ))
+                self.db.execute("DELETE FROM files WHERE dir = ?", (rel, ))
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES ('scan_ns', ?)", (str(time.time_ns()), ))
+        self.db.commit()
+        self.load()
+        return self
+
+    def shared_scan(self, max_age):
+        # For several processes on one index file (ranks of a node): the first one scans,
+        # the others load its result while it is younger than max_age seconds.
+        if not self.index_path or fcntl is None:
+            return self.scan()
+        with open(self.index_path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                row = self.db.execute("SELECT value FROM meta WHERE key = 'scan_ns'").fetchone()
+                if row is not None and time.time_ns() - int(row[0]) < max_age * 1e9:
+                    self.rescanned = []
+                    self.load()
+                    return self
+                return self.scan()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def save_npy(self, suffix, a):
+        # Written aside and renamed, so other processes never load a partial file.
+        tmp = "%s%s.%d.tmp.npy" % (self.index_path, suffix, os.getpid())
+        np.save(tmp, a)
+        os.replace(tmp, self.index_path + suffix + ".npy")
+
+    def load(self):
+        self.dirs = [row[0] for row in self.db.execute("SELECT path FROM dirs ORDER BY path")]
+        dir_index = {d: i for i, d in enumerate(self.dirs)}
+        files = []
+        file_dirs = []
+        sizes = []
+        mtimes = []
+        for d, name, size, mtime_ns in self.db.execute("SELECT dir, name, size, mtime_ns FROM files ORDER BY dir, name"):
+            files.append(name)
+            file_dirs.append(dir_index[d])
+            sizes.append(size)
+            mtimes.append(mtime_ns)
+        self.files = files
+        self.file_dirs = np.array(file_dirs, dtype=np.int32)
+        self.sizes = np.array(sizes, dtype=np.int64)
+        self.mtimes = np.array(mtimes, dtype=np.int64)
+
+    def dir_signals(self, classes, make_signal):
+        # D x C signal matrix. Reused from disk while neither the classes nor the listing changed.
+        key = json.dumps([classes, len(self.dirs), len(self.files)], sort_keys=True)
+        if self.index_path:
+            row = self.db.execute("SELECT value FROM meta WHERE key = 'signals'").fetchone()
+            if row is not None and row[0] == key and len(self.rescanned) == 0:
+                try:
+                    return np.load(self.index_path + ".signals.npy")
+                except (OSError, ValueError):
+                    pass
+        signals = np.zeros((len(self.dirs), len(classes)), dtype=np.float32)
+        for i, d in enumerate(self.dirs):
+            # make_signal only looks at path components, so a dummy file name stands in for every file of the directory.
+            signals[i] = make_signal(self.entry, os.path.join(self.entry, d, "."), classes)
+        if self.index_path:
+            self.save_npy(".signals", signals)
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('signals', ?)", (key, ))
+            self.db.commit()
+        return signals
@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+import collections
 import logging
 import struct
 
@@ -43,11 +44,39 @@ def to_bytes(d):
         return d.encode('utf-8')
     if isinstance(d, list):
         return bytearray(d)
+    if isinstance(d, memoryview):
+        return d
     if type(d).__module__ == np.__name__:
         return bytearray(d)
     return False
 
 
+def to_buffer(d):
+    # Like to_bytes but keeps bytes and memoryviews by reference. A memoryview is owned by the stream until
+    # the socket drains it, so its exporter must not change it (encoder output is a fresh view per frame).
+    # Mutable containers (bytearray, ndarray) are snapshotted, callers may reuse them right after write().
+    if isinstance(d, bytes):
+        return d
+    if isinstance(d, bytearray):
+        return bytes(d)
+    if isinstance(d, memoryview):
+        return d.cast("B") if d.format != "B" or d.ndim != 1 else d
+    if isinstance(d, str):
+        return d.encode('utf-8')
+    if isinstance(d, list):
+        return bytes(d)
+    if isinstance(d, np.ndarray):
+        return d.tobytes()
+    return False
+
+
+def encoded_view(d):
+    # Encoder output -> flat memoryview, passed to the stream without a copy.
+    if isinstance(d, np.ndarray):
+        return memoryview(np.ascontiguousarray(d)).cast("B")
+    return d
+
+
 class StreamIO:
     def __init__(self):
         self.b = bytearray()
@@ -86,6 +115,53 @@ class StreamIO:
         return len(self.b)
 
 
+class StreamChain:
+    # Ordered list of buffer chunks. Nothing is copied until read() joins them once.
+    def __init__(self):
+        self.chunks = collections.deque()
+        self.nbytes = 0
+
+    def read(self, size=-1):
+        if size == -1 or size >= self.nbytes:
+            b = b"".join(self.chunks)
+            self.chunks.clear()
+            self.nbytes = 0
+            return b
+        # Only the chunks covering the first size bytes are joined, the rest stay referenced.
+        out = []
+        need = size
+        while need > 0:
+            c = self.chunks[0]
+            if len(c) <= need:
+                out.append(self.chunks.popleft())
+                need -= len(c)
+            else:
+                c = memoryview(c)
+                out.append(c[0:need])
+                self.chunks[0] = c[need:]
+                need = 0
+        self.nbytes -= size
+        return b"".join(out)
+
+    def write(self, data):
+        _data = to_buffer(data)
+        if _data is False:
+            ex = "expected type is bytes. Got object was " + str(type(data))
+            warn(ex)
+            raise Exception(ex)
+        slen = len(_data)
+        if slen > 0:
+            self.chunks.append(_data)
+            self.nbytes += slen
+        return slen
+
+    def size(self):
+        return self.nbytes
+
+    def length(self):
+        return self.nbytes
+
+
 class DirectStream:
     def __init__(self):
         self.queue_name = None
@@ -157,7 +233,7 @@ class LengthSplitIn:  # Stream(socket) to Blocks
 class LengthSplitOut:  # Block(s) to Stream(socket)
     def __init__(self, max_buffer_size=1024 * 1024 * 10):
         self.queue_name = None
-        self.buffer = StreamIO()
+        self.buffer = StreamChain()
         self.max_buffer_size = max_buffer_size
 
     # single data block to stream
@@ -166,13 +242,19 @@ class LengthSplitOut:  # Block(s) to Stream(socket)
 
         tlen = 0
         blen = self.buffer.length()
+        buffers = []
         for data in blocks:
-            tlen += len(data)
+            _data = to_buffer(data)
+            if _data is False:
+                raise Exception("expected type is bytes. Got object was " + str(type(data)))
+            buffers.append(_data)
+            tlen += len(_data)
         if tlen + blen > self.max_buffer_size:
             debug("LengthSplitOut:write", "Data size:", tlen, "Buffer size:", blen)
             raise Exception("too much data size")
 
-        for data in blocks:
+        # Encoded images are referenced, not copied, until the socket read joins them.
+        for data in buffers:
             slen = len(data)
             blen = slen.to_bytes(4, 'big')
             self.buffer.write(blen)
@@ -192,13 +274,16 @@ class LengthSplitOut:  # Block(s) to Stream(socket)
 
 
 class ImageDecoder:  # Blocks to Blocks
-    def __init__(self, *, queue_name="default"):
+    def __init__(self, *, queue_name="default", workers=None, min_size=None, color_order=None):
         self.input_blocks = []
         self.processing_map = {}
         self.output_blocks = []
         self.rcv_index = 0
         self.req_index = 0
         self.queue_name = queue_name
+        self.workers = workers
+        self.min_size = min_size
+        self.color_order = color_order
 
     def write(self, blocks):
         check_type(blocks, "W:ImageDecoder")
@@ -248,8 +333,8 @@ class ImageDecoder:  # Blocks to Blocks
                     self.input_blocks = []
             else:
                 # for b in self.input_blocks: self.output_blocks.append(aimage.native_decoder(b))
-                for b in self.input_blocks:
-                    self.output_blocks.append(aimage.opencv_decoder(b))
+                if len(self.input_blocks) > 0:
+                    self.output_blocks += aimage.decode_batch(self.input_blocks, workers=self.workers, min_size=self.min_size, color_order=self.color_order)
                 self.input_blocks = []
         except Exception as e:
             warn(e)
@@ -260,7 +345,7 @@ class ImageDecoder:  # Blocks to Blocks
 
 
 class ImageEncoder:  # Blocks to Blocks
-    def __init__(self, *, queue_name="default", quality=90):
+    def __init__(self, *, queue_name="default", quality=90, color_order=None):
         self.input_blocks = []
         self.processing_map = {}
         self.output_blocks = []
@@ -268,6 +353,7 @@ class ImageEncoder:  # Blocks to Blocks
         self.rcv_index = 0
         self.queue_name = queue_name
         self.quality = quality
+        self.color_order = color_order
 
     def write(self, blocks):
         slen = 0
@@ -276,7 +362,7 @@ class ImageEncoder:  # Blocks to Blocks
             raise Exception("Arg must be list(numpy,numpy,...)")
         for data in blocks:
             slen += len(data)
-            self.input_blocks.append(np.uint8(data))
+            self.input_blocks.append(np.array(data, dtype=np.uint8))  # Copied: encoding runs later in update(), callers may reuse their frame.
         return slen
 
     def read(self, size=-1):
@@ -323,20 +409,20 @@ class ImageEncoder:  # Blocks to Blocks
                     while True:
                         obj = self.processing_map.pop(self.rcv_index, None)
                         if obj:
-                            self.output_blocks.append(obj["data"])
+                            self.output_blocks.append(encoded_view(obj["data"]))
                             self.rcv_index += 1
                         else:
                             break
                 else:
                     # for b in self.input_blocks: self.output_blocks.append(aimage.native_encoder(b))
                     for b in self.input_blocks:
-                        self.output_blocks.append(aimage.native_fast_encoder(b))  # x3~x4 faster than OpenCV imdecode loader.
+                        self.output_blocks.append(encoded_view(aimage.native_fast_encoder(b)))  # x3~x4 faster than OpenCV imdecode loader.
                         # self.output_blocks.append(aimage.native_encoder(b, quality=self.quality, format="jpg"))
                     self.input_blocks = []
             else:
                 # for b in self.input_blocks: self.output_blocks.append(aimage.native_encoder(b))
                 for b in self.input_blocks:
-                    self.output_blocks.append(aimage.opencv_encoder(b))
+                    self.output_blocks.append(aimage.opencv_encoder(b, quality=self.quality, color_order=self.color_order))
                 self.input_blocks = []
         except Exception as e:
             print("Critical:", e)
@@ -344,7 +430,7 @@ class ImageEncoder:  # Blocks to Blocks
             exit(9)
 
     def info(self):
-        return "ImageEncoder: Image data block <[<ndarray>,]> => <[<bytes>,]>"
+        return "ImageEncoder: Image data block <[<ndarray>,]> => <[<memoryview>,]>"
 
 
 def protocols():
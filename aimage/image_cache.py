@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+import collections
+import concurrent.futures
+import os
+import tempfile
+import threading
+
+import numpy as np
+from aimage.shared_batch import SampleRing, attach
+
+# Global budget, see set_max_cache_size(). Every generator gets its own cache of this size.
+max_cache_size = 0
+spill_dir = None
+spill_size = 0
+
+_memmaps = {}
+
+
+def set_max_cache_size(size, spill_path=None, spill_bytes=0):  # @public
+    # size: bytes of RAM for decoded, target-size images. 0 disables the cache.
+    # spill_path: directory on local disk for an optional memory-mapped second tier of spill_bytes.
+    global max_cache_size, spill_dir, spill_size
+    max_cache_size = int(size)
+    spill_dir = spill_path
+    spill_size = int(spill_bytes)
+
+
+class _Entry:
+    __slots__ = ("tier", "slot", "pins", "ready", "failed", "future")
+
+    def __init__(self, tier, slot):
+        self.tier = tier
+        self.slot = slot
+        self.pins = 1
+        self.ready = False
+        self.failed = False
+        self.future = None
+
+
+class ImageCache:
+    # LRU cache of target-size uint8 images in fixed size slots, keyed by (path, mtime, size, target_size).
+    # Bookkeeping stays in the consumer thread. The pixels live in a SampleRing (shared memory for
+    # process workers) plus an optional np.memmap spill file, so loader workers read and fill slots
+    # directly. Entries used by queued loads are pinned and never evicted under them.
+    # meta_size > 0 keeps that many float32 values per entry next to the pixels (thread workers only).
+    RAM = 0
+    DISK = 1
+
+    def __init__(self, shape, max_bytes, spill_dir=None, spill_bytes=0, shared=False, meta_size=0):
+        self.shape = tuple(shape)
+        slot_bytes = int(np.prod(self.shape))
+        self.ram = SampleRing(max(1, max_bytes // slot_bytes), self.shape, np.uint8, shared=shared)
+        self.disk = None
+        self.disk_path = None
+        disk_slots = spill_bytes // slot_bytes if spill_dir else 0
+        if disk_slots > 0:
+            fd, self.disk_path = tempfile.mkstemp(prefix="aimage-cache-", suffix=".bin", dir=spill_dir)
+            os.close(fd)
+            self.disk = np.memmap(self.disk_path, dtype=np.uint8, mode="w+", shape=(disk_slots, ) + self.shape)
+        self.lru = [collections.OrderedDict(), collections.OrderedDict()]
+        self.free = [list(range(self.ram.slots)), list(range(disk_slots))]
+        self.meta = None
+        if meta_size > 0:
+            self.meta = [np.zeros((self.ram.slots, meta_size), dtype=np.float32), np.zeros((disk_slots, meta_size), dtype=np.float32)]
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def create(shape, shared=False, meta_size=0):
+        if max_cache_size <= 0:
+            return None
+        return ImageCache(shape, max_cache_size, spill_dir, spill_size, shared, meta_size)
+
+    def handle(self):
+        return (self.ram.handle(), self.disk_path, self.shape, self.meta)
+
+    def nbytes(self):
+        return sum([len(lru) for lru in self.lru]) * int(np.prod(self.shape))
+
+    def find(self, key):
+        for tier in (ImageCache.RAM, ImageCache.DISK):
+            e = self.lru[tier].get(key)
+            if e is not None:
+                return e
+        return None
+
+    def evict(self, tier):
+        # Least recently used entry of the tier that no queued load depends on.
+        for key, e in self.lru[tier].items():
+            if e.pins == 0:
+                del self.lru[tier][key]
+                return key, e
+        return None, None
+
+    def take_slot(self, tier):
+        if len(self.free[tier]) > 0:
+            return self.free[tier].pop()
+        key, e = self.evict(tier)
+        if e is None:
+            return None
+        if tier == ImageCache.RAM and self.disk is not None:
+            slot = self.take_slot(ImageCache.DISK)
+            if slot is not None:
+                self.disk[slot] = self.ram.array[e.slot]
+                if self.meta is not None:
+                    self.meta[ImageCache.DISK][slot] = self.meta[ImageCache.RAM][e.slot]
+                e.tier = ImageCache.DISK
+                ram_slot = e.slot
+                e.slot = slot
+                self.lru[ImageCache.DISK][key] = e
+                return ram_slot
+        return e.slot
+
+    def acquire(self, key):
+        # Returns ("hit", (tier, slot)) to copy from, ("fill", (tier, slot)) to decode into, or ("load", None).
+        # ("wait", (tier, slot)): a queued load is still filling the entry, copy from it once filling(key) is done.
+        e = self.find(key)
+        if e is not None:
+            if e.failed:
+                return "load", None
+            e.pins += 1
+            self.lru[e.tier].move_to_end(key)
+            self.hits += 1
+            return ("hit" if e.ready else "wait"), (e.tier, e.slot)
+        self.misses += 1
+        slot = self.take_slot(ImageCache.RAM)
+        if slot is None:
+            return "load", None
+        self.lru[ImageCache.RAM][key] = _Entry(ImageCache.RAM, slot)
+        return "fill", (ImageCache.RAM, slot)
+
+    def acquire_tasks(self, items, keys):
+        # One chunk of loads: items with their keys (None: not cacheable) -> the loader tasks (item, src, dst),
+        # the (key, filled) pairs to release and the tasks waiting for a queued fill, see submit_after().
+        tasks = []
+        held = []
+        waits = []
+        for item, key in zip(items, keys):
+            src = None
+            dst = None
+            state, loc = ("load", None) if key is None else self.acquire(key)
+            if state == "wait" and self.filling(key) is None:
+                # Filled by an earlier task of this chunk, which is not submitted yet.
+                self.release([(key, False)])
+                state = "load"
+            if state == "wait":
+                waits.append((len(tasks), self.filling(key)))
+            if state in ("hit", "wait"):
+                src = loc
+                held.append((key, False))
+            elif state == "fill":
+                dst = loc
+                held.append((key, True))
+            tasks.append((item, src, dst))
+        return tasks, held, waits
+
+    def submitted(self, held, future):
+        # The chunk of acquire_tasks() was submitted, later chunks wait for its fills.
+        for key, filled in held:
+            if filled:
+                self.filling(key, future)
+
+    def filling(self, key, future=None):
+        # Sets (future given) or returns the future of the load filling a not yet ready entry.
+        e = self.find(key)
+        if future is not None:
+            e.future = future
+        return e.future
+
+    def release(self, keys, ok=True):
+        # Called once the load that acquired `keys` finished (ok) or was cancelled.
+        # keys: (key, filled) pairs, filled is True for the entries the load decoded into.
+        for key, filled in keys:
+            e = self.find(key)
+            if e is None:
+                continue
+            e.pins -= 1
+            if filled:
+                e.future = None
+                if ok:
+                    e.ready = True
+                else:
+                    e.failed = True
+            if e.failed and e.pins == 0:
+                del self.lru[e.tier][key]
+                self.free[e.tier].append(e.slot)
+
+    def close(self):
+        self.ram.close()
+        if self.disk is not None:
+            self.disk = None
+            os.remove(self.disk_path)
+            self.disk_path = None
+
+
+def cache_slot(handle, loc):
+    # Worker side: the array behind a (tier, slot) location of ImageCache.handle().
+    ram, disk_path, shape, meta = handle
+    tier, slot = loc
+    if tier == ImageCache.RAM:
+        return attach(ram)[slot]
+    if disk_path not in _memmaps:
+        _memmaps[disk_path] = np.memmap(disk_path, dtype=np.uint8, mode="r+", shape=None)
+    return _memmaps[disk_path].reshape((-1, ) + tuple(shape))[slot]
+
+
+def cache_meta(handle, loc):
+    # Worker side: the meta values of a (tier, slot) location.
+    tier, slot = loc
+    return handle[3][tier][slot]
+
+
+def submit_after(submit, waits, tasks, fn, *args):
+    # submit(fn, *args) once the loads in waits [(task index, future filling its entry)] are done, so those
+    # tasks copy from the cache instead of decoding the image again. tasks are (path, src, dst) and are passed
+    # in args, a waiting task whose fill failed is turned into a plain load. Returns the future of fn.
+    pending = [future for k, future in waits if future.done() is False]
+    if len(pending) == 0:
+        _fallback(waits, tasks)
+        return submit(fn, *args)
+    outer = concurrent.futures.Future()
+    lock = threading.Lock()
+    left = [len(pending)]
+
+    def start(f):
+        with lock:
+            left[0] -= 1
+            if left[0] > 0:
+                return
+        if any(future.cancelled() for k, future in waits):
+            # Only drain() cancels, and it drops this load as well.
+            outer.cancel()
+        if outer.set_running_or_notify_cancel() is False:
+            return
+        _fallback(waits, tasks)
+        try:
+            submit(fn, *args).add_done_callback(lambda inner: _forward(inner, outer))
+        except Exception as e:
+            outer.set_exception(e)
+
+    for future in pending:
+        future.add_done_callback(start)
+    return outer
+
+
+def _fallback(waits, tasks):
+    for k, future in waits:
+        if future.cancelled() or future.exception() is not None:
+            tasks[k] = (tasks[k][0], None, None)
+
+
+def _forward(inner, outer):
+    if inner.cancelled():
+        outer.set_exception(concurrent.futures.CancelledError())
+    elif inner.exception() is not None:
+        outer.set_exception(inner.exception())
+    else:
+        outer.set_result(inner.result())
@@ -1,10 +1,15 @@
 #!/usr/bin/env python3
 
+import concurrent.futures
+import functools
 import math
 import mimetypes
+import os
+import threading
 
 import numpy as np
 import cv2
+from aimage.probe import probe_buffer, probe_file
 
 CRED = '\033[0;31m'
 CCYAN = '\033[0;36m'
@@ -15,23 +20,13 @@ FONT_TYPE = [cv2.FONT_HERSHEY_COMPLEX_SMALL, cv2.FONT_HERSHEY_SIMPLEX, cv2.FONT_
 
 
 def gamma(img, g):  # @public
-    lookUpTable = np.empty((1, 256), np.uint8)
-    for i in range(256):
-        lookUpTable[0, i] = np.clip(pow(i / 255.0, g) * 255.0, 0, 255)
-    img = cv2.LUT(img, lookUpTable)
-    return img
+    from aimage.color_adjust import adjust_gamma
+    return adjust_gamma(img, g)
 
 
 def hue(img, h=0, s=0, v=0):  # @public
-    img = cv2.cvtColor(img, cv2.COLOR_RGB2HSV)
-    if h != 0:
-        img[:, :, 1] += h
-    if s != 0:
-        img[:, :, 1] += s
-    if v != 0:
-        img[:, :, 2] += v
-    img = cv2.cvtColor(img, cv2.COLOR_HSV2RGB)
-    return img
+    from aimage.color_adjust import adjust_hsv
+    return adjust_hsv(img, h=h, s=s, v=v)
 
 
 def flip(img, t):  # @public
@@ -39,43 +34,62 @@ def flip(img, t):  # @public
 
 
 def bchw2bhwc(ts):  # @public
+    # torch tensor or ndarray. Returns a view, np.ascontiguousarray() / .contiguous() copies.
+    if isinstance(ts, np.ndarray):
+        return np.moveaxis(ts, -3, -1)
     s = len(ts.size())
     return ts.transpose(s - 3, s - 2).transpose(s - 2, s - 1)
 
 
 def bhwc2bchw(ts):  # @public
+    if isinstance(ts, np.ndarray):
+        return np.moveaxis(ts, -1, -3)
     s = len(ts.size())
     return ts.transpose(s - 2, s - 1).transpose(s - 3, s - 2)
 
 
 def concat_bhwc_image(ts):
-    ts = np.array(ts)
-    bsize = len(ts)
-    rt = int(math.ceil(math.sqrt(bsize)))
-    i = 0
-    row = None
-    for y in range(rt):
-        col = None
-        for x in range(rt):
-            if i >= bsize:
-                break
-            b = ts[i]
-            if col is not None:
-                col = cv2.hconcat([col, b])
-            else:
-                col = b
-            i += 1
-        if row is not None:
-            try:
-                row = cv2.vconcat([row, col])
-            except:
-                pass
+    return make_mosaic(ts)
+
+
+def make_mosaic(images, cols=None, scale=1.0, pad=0, pad_value=0):  # @public
+    # images: NHWC array or a list of HWC images (sizes may differ). Float and uint8 are both kept as is.
+    # The canvas is allocated once and every tile is blitted into its cell. Smaller tiles are padded.
+    n = len(images)
+    if n == 0:
+        return None
+    if cols is None:
+        cols = int(math.ceil(math.sqrt(n)))
+    rows = int(math.ceil(n / cols))
+    shapes = []
+    for img in images:
+        th = img.shape[0]
+        tw = img.shape[1]
+        if scale != 1.0:
+            th = max(1, int(th * scale))
+            tw = max(1, int(tw * scale))
+        shapes.append((th, tw))
+    ch = max([sh[0] for sh in shapes])
+    cw = max([sh[1] for sh in shapes])
+    c = max([img.shape[2] if img.ndim == 3 else 1 for img in images])
+    dtype = np.result_type(*[img.dtype for img in images])
+    canvas = np.empty((rows * ch + (rows - 1) * pad, cols * cw + (cols - 1) * pad, c), dtype=dtype)
+    canvas[...] = pad_value
+    for i in range(n):
+        img = images[i]
+        if img.ndim == 2:
+            img = img[..., None]
+        th, tw = shapes[i]
+        y = (i // cols) * (ch + pad)
+        x = (i % cols) * (cw + pad)
+        dst = canvas[y:y + th, x:x + tw]
+        if scale == 1.0:
+            dst[...] = img
+        elif img.dtype == dtype and img.shape[2] == c:
+            _resize_into(img, dst, cv2.INTER_AREA)
         else:
-            row = col
-        if i == bsize - 1:
-            break
-
-    return row  #np.array(row * 255, dtype=np.uint8)
+            dst[...] = cv2.resize(img, (tw, th), interpolation=cv2.INTER_AREA).reshape(th, tw, -1)
+    return canvas
 
 
 def rgb2bgr(img):  # @public
@@ -134,7 +148,75 @@ def is_image_ext(f):  # @public
     return False
 
 
-def opencv_decoder(data):
+COLOR_ORDER = "rgb"  # Channel order of arrays handed to / returned from aimage. OpenCV itself is "bgr".
+
+
+def set_color_order(color_order):  # @public
+    global COLOR_ORDER
+    if color_order not in ("rgb", "bgr"):
+        raise Exception("color_order must be \"rgb\" or \"bgr\". Invalid arg:" + str(color_order))
+    COLOR_ORDER = color_order
+
+
+def get_color_order():  # @public
+    return COLOR_ORDER
+
+
+def _is_rgb(color_order):
+    if color_order is None:
+        color_order = COLOR_ORDER
+    if color_order not in ("rgb", "bgr"):
+        raise Exception("color_order must be \"rgb\" or \"bgr\". Invalid arg:" + str(color_order))
+    return color_order == "rgb"
+
+
+def _from_bgr(img, color_order=None, dst=None):
+    # OpenCV output -> requested order. The swap is done in place (or into dst), so the result stays contiguous.
+    if img is None:
+        return None
+    if _is_rgb(color_order) is False or img.ndim != 3 or img.shape[2] != 3:
+        if dst is not None:
+            dst[...] = img
+            return dst
+        return img
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB, dst=img if dst is None else dst)
+
+
+def _to_bgr(img, color_order=None):
+    # Requested order -> OpenCV input. BGR data is passed through untouched.
+    if _is_rgb(color_order) is False or img.ndim != 3 or img.shape[2] != 3:
+        return img
+    if img.dtype in (np.uint8, np.uint16, np.float32):
+        return cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
+    return img[..., ::-1]
+
+
+_REDUCED_COLOR_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+_REDUCED_GRAYSCALE_FLAGS = ((8, cv2.IMREAD_REDUCED_GRAYSCALE_8), (4, cv2.IMREAD_REDUCED_GRAYSCALE_4), (2, cv2.IMREAD_REDUCED_GRAYSCALE_2))
+
+
+def _reduced_decode_flag(nb, min_size=None, max_side=None, grayscale=False):
+    # IMREAD_REDUCED_COLOR_* scales in the DCT domain, which only pays off for JPEG.
+    full = cv2.IMREAD_GRAYSCALE if grayscale else cv2.IMREAD_COLOR
+    if min_size is None and max_side is None:
+        return full
+    head = probe_buffer(nb)
+    if head is None or head["type"] != "jpeg":
+        return full
+    w, h = head["width"], head["height"]
+    for f, flag in (_REDUCED_GRAYSCALE_FLAGS if grayscale else _REDUCED_COLOR_FLAGS):
+        rw = (w + f - 1) // f
+        rh = (h + f - 1) // f
+        # SOF dimensions are before EXIF rotation, so compare orientation-agnostically.
+        if min_size is not None and min(rw, rh) < max(min_size[0], min_size[1]):
+            continue
+        if max_side is not None and max(rw, rh) < max_side:
+            continue
+        return flag
+    return full
+
+
+def opencv_decoder(data, *, min_size=None, max_side=None, color_order=None):
     b = data
     if isinstance(data, np.ndarray):
         nb = data
@@ -142,23 +224,24 @@ def opencv_decoder(data):
         nb = np.frombuffer(b, dtype=np.uint8)
     elif isinstance(data, bytearray):
         nb = np.frombuffer(b, dtype=np.uint8)
+    elif isinstance(data, memoryview):
+        nb = np.frombuffer(b, dtype=np.uint8)
     else:
-        raise Exception("Arg type must be bytes/bytearray/ndarray. Invalid arg:" + type(data))
-    data = cv2.imdecode(nb, cv2.IMREAD_COLOR)
-    data = data[..., ::-1]
-
-    return data
+        raise Exception("Arg type must be bytes/bytearray/memoryview/ndarray. Invalid arg:" + str(type(data)))
+    data = cv2.imdecode(nb, _reduced_decode_flag(nb, min_size, max_side))
+    return _from_bgr(data, color_order)
 
 
 def opencv_encoder(data, **kargs):
+    # Returns a flat memoryview over the encoded array so the framing layer can pass it through without copying.
     quality = 90
     if "quality" in kargs:
         quality = kargs["quality"]
-    data = data[..., ::-1]
+    data = _to_bgr(data, kargs.get("color_order"))
     check, data = cv2.imencode(".jpg", data, [int(cv2.IMWRITE_JPEG_QUALITY), quality])  # quality 1-100
     if check is False:
-        raise "Invalid image data"
-    return data
+        raise Exception("Invalid image data")
+    return memoryview(data).cast("B")
 
 
 def pillow_decoder(data):
@@ -173,22 +256,24 @@ def pillow_encoder(data, **kargs):
     return d
 
 
-def _opencv_decoder_(data):
+def _opencv_decoder_(data, min_size=None, max_side=None, color_order=None):
     b = data
-    nb = np.asarray(b, dtype=np.uint8)
-    data = cv2.imdecode(nb, cv2.IMREAD_COLOR)
-    data = data[..., ::-1]
-    return data
+    if isinstance(b, (bytes, bytearray, memoryview)):
+        nb = np.frombuffer(b, dtype=np.uint8)
+    else:
+        nb = np.asarray(b, dtype=np.uint8)
+    data = cv2.imdecode(nb, _reduced_decode_flag(nb, min_size, max_side))
+    return _from_bgr(data, color_order)
 
 
 def _opencv_encoder_(data, **kargs):
     quality = 90
     if "quality" in kargs:
         quality = kargs["quality"]
-    data = data[..., ::-1]
+    data = _to_bgr(data, kargs.get("color_order"))
     check, data = cv2.imencode(".jpg", data, [int(cv2.IMWRITE_JPEG_QUALITY), quality])  # quality 1-100
     if check is False:
-        raise "Invalid image data"
+        raise Exception("Invalid image data")
     return data
 
 
@@ -224,37 +309,111 @@ def native_fast_save_image(path, data, *, quality=90, format="jpg"):
     raise Exception("You must install aimage-native-ext")
 
 
-def decoder(data):  # @public
-    return _opencv_decoder_(data)
+def decoder(data, *, min_size=None, max_side=None, color_order=None):  # @public
+    # min_size=(w,h) / max_side: smallest acceptable result. JPEGs are decoded at 1/2, 1/4 or 1/8 scale when that still covers it.
+    # color_order: "rgb" / "bgr", defaults to COLOR_ORDER (see set_color_order).
+    return _opencv_decoder_(data, min_size, max_side, color_order)
 
 
 def encoder(data, **kargs):  # @public
     return _opencv_encoder_(data, **kargs)
 
 
-def load_image(path):  # @public
-    img = cv2.imread(path)
-    img = img[..., ::-1]
-    return img
+_thread_pools = {}
+_thread_pools_lock = threading.Lock()
+
+
+def _thread_pool(workers=None):
+    if workers is None or workers <= 0:
+        workers = os.cpu_count() or 1
+    with _thread_pools_lock:
+        pool = _thread_pools.get(workers)
+        if pool is None:
+            pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="aimage")
+            _thread_pools[workers] = pool
+    return pool
+
+
+def decode_batch(buffers, workers=None, out=None, *, min_size=None, color_order=None):  # @public
+    # cv2.imdecode releases the GIL, so a thread pool scales with cores.
+    # out: optional preallocated NHWC uint8 array. Every image must match out.shape[1:].
+    n = len(buffers)
+    if out is not None:
+        if isinstance(out, np.ndarray) is False or out.dtype != np.uint8 or out.ndim != 4:
+            raise Exception("out must be NHWC uint8 numpy.")
+        if len(out) < n:
+            raise Exception("out batch size(%d) is smaller than buffers(%d)." % (len(out), n))
+
+    def task(i):
+        if out is None:
+            img = opencv_decoder(buffers[i], min_size=min_size, color_order=color_order)
+            if img is None:
+                raise Exception("Invalid image data. index:%d" % (i, ))
+            return img
+        img = opencv_decoder(buffers[i], min_size=min_size, color_order="bgr")
+        if img is None:
+            raise Exception("Invalid image data. index:%d" % (i, ))
+        if img.shape != out.shape[1:]:
+            raise Exception("Shape mismatch. index:%d %s != %s" % (i, str(img.shape), str(out.shape[1:])))
+        _from_bgr(img, color_order, dst=out[i])
+        return None
+
+    if n <= 1 or workers == 1:
+        results = [task(i) for i in range(n)]
+    else:
+        results = list(_thread_pool(workers).map(task, range(n)))
+    if out is not None:
+        return out[:n]
+    return results
 
 
-def save_image(path, data, *, quality=90, format="jpg"):  # @public
-    data = data[..., ::-1]
+def load_image(path, *, min_size=None, max_side=None, color_order=None):  # @public
+    if min_size is None and max_side is None:
+        img = cv2.imread(path)
+    else:
+        nb = np.fromfile(path, dtype=np.uint8)
+        img = cv2.imdecode(nb, _reduced_decode_flag(nb, min_size, max_side))
+    return _from_bgr(img, color_order)
+
+
+def save_image(path, data, *, quality=90, format="jpg", color_order=None):  # @public
+    data = _to_bgr(data, color_order)
     return cv2.imwrite(path, data, [cv2.IMWRITE_JPEG_QUALITY, quality])
 
 
-def load(path):  # @public
+def load(path, *, color_order=None):  # @public
     t, ext = mimetypes.guess_type(path)[0].split("/")
     if t == "image":
         img = cv2.imread(path, 3)
         if img is None:
             print(CRED, "\n\nInvalid image file or invalid path. \"%s\"\n\n" % (path, ), CRESET)
             raise "Invalid file or invalid path."
-        return img[..., ::-1]
+        return _from_bgr(img, color_order)
     print(CRED, "\n\nInvalid image file or invalid path. \"%s\"\n\n" % (path, ), CRESET)
     return None
 
 
+INTERPOLATION = {
+    "fastest": cv2.INTER_LINEAR,  # Cheapest filter that is still fit for training data.
+    "nearest": cv2.INTER_NEAREST,
+    "linear": cv2.INTER_LINEAR,
+    "area": cv2.INTER_AREA,
+    "cubic": cv2.INTER_CUBIC,
+    "lanczos": cv2.INTER_LANCZOS4,
+}
+
+
+def interpolation_flag(interpolation):  # @public
+    if isinstance(interpolation, int):
+        return interpolation
+    if isinstance(interpolation, str) and interpolation.isdigit():
+        # cv2.INTER_* value stringified with the rest of data_aug_params.
+        return int(interpolation)
+    if interpolation not in INTERPOLATION:
+        raise Exception("interpolation must be one of " + str(list(INTERPOLATION.keys())) + ". Invalid arg:" + str(interpolation))
+    return INTERPOLATION[interpolation]
+
+
 def ratio_resize(img, ww, interpolation="fastest"):  # @public
     s = 1
     if img.shape[0] < img.shape[1]:
@@ -263,7 +422,7 @@ def ratio_resize(img, ww, interpolation="fastest"):  # @public
         s = ww / img.shape[0]
     w = int(img.shape[1] * s)
     h = int(img.shape[0] * s)
-    return cv2.resize(img, (w, h), interpolation=cv2.INTER_AREA)
+    return cv2.resize(img, (w, h), interpolation=interpolation_flag(interpolation))
 
 
 def crop(img, x, y, x2, y2):  # @public
@@ -273,7 +432,69 @@ def crop(img, x, y, x2, y2):  # @public
 def resize(img, w, h=None, interpolation="fastest"):  # @public
     if h is None:
         return ratio_resize(img, w, interpolation)
-    return cv2.resize(img, (w, h), interpolation=cv2.INTER_AREA)
+    return cv2.resize(img, (w, h), interpolation=interpolation_flag(interpolation))
+
+
+def _resize_into(img, dst, interpolation):
+    r = cv2.resize(img, (dst.shape[1], dst.shape[0]), dst=dst, interpolation=interpolation)
+    if r is not dst:
+        dst[...] = r.reshape(dst.shape)
+
+
+def resize_batch(images, size, mode="stretch", interpolation="fastest", out=None, workers=None, pad_value=0):  # @public
+    # images: list of HWC images (or an NHWC array), size: (w, h).
+    # mode:
+    #  - stretch: ignore the aspect ratio.
+    #  - ratio: keep the aspect ratio, align to the top left and pad the rest.
+    #  - letterbox: keep the aspect ratio, center and pad.
+    # Returns (out, scales, offsets). scales/offsets are float32 (N, 2) as (x, y) so that
+    # out_xy = in_xy * scale + offset, e.g. to map boxes back: in_xy = (out_xy - offset) / scale.
+    if mode not in ("stretch", "ratio", "letterbox"):
+        raise Exception("mode must be stretch/ratio/letterbox. Invalid arg:" + str(mode))
+    n = len(images)
+    w, h = int(size[0]), int(size[1])
+    flag = interpolation_flag(interpolation)
+    if out is None:
+        if n == 0:
+            raise Exception("Empty images.")
+        first = images[0]
+        out = np.empty((n, h, w) + tuple(first.shape[2:]), dtype=first.dtype)
+    elif len(out) < n or out.shape[1] != h or out.shape[2] != w:
+        raise Exception("out shape %s does not fit %d images of %dx%d." % (str(out.shape), n, w, h))
+    scales = np.empty((n, 2), dtype=np.float32)
+    offsets = np.zeros((n, 2), dtype=np.float32)
+
+    def task(i):
+        img = images[i]
+        ih, iw = img.shape[0], img.shape[1]
+        dst = out[i]
+        if mode == "stretch":
+            _resize_into(img, dst, flag)
+            scales[i] = (w / iw, h / ih)
+            return
+        s = min(w / iw, h / ih)
+        nw = min(w, max(1, int(round(iw * s))))
+        nh = min(h, max(1, int(round(ih * s))))
+        ox = 0
+        oy = 0
+        if mode == "letterbox":
+            ox = (w - nw) // 2
+            oy = (h - nh) // 2
+        # Only the borders are filled, the resized image is written in place.
+        dst[0:oy] = pad_value
+        dst[oy + nh:] = pad_value
+        dst[oy:oy + nh, 0:ox] = pad_value
+        dst[oy:oy + nh, ox + nw:] = pad_value
+        _resize_into(img, dst[oy:oy + nh, ox:ox + nw], flag)
+        scales[i] = (nw / iw, nh / ih)
+        offsets[i] = (ox, oy)
+
+    if n <= 1 or workers == 1:
+        for i in range(n):
+            task(i)
+    else:
+        list(_thread_pool(workers).map(task, range(n)))
+    return out[:n], scales, offsets
 
 
 def draw_rect(img, s, t, c=(255, 0, 0), line=2):  # @public
@@ -285,19 +506,47 @@ def draw_fill_rect(img, s, t, c=(255, 0, 0)):  # @public
 
 
 def file_type(d):  # @public
-    print("image_head: Does not support API.")
-    return None
+    info = probe_file(d)
+    if info is None:
+        return None
+    return info["type"]
 
 
 def image_head(d):  # @public
+    info = probe_file(d)
+    if info is not None:
+        return info
+    # Unknown container. Fall back to a full decode.
     img = cv2.imread(d)
     info = {}
+    info["type"] = None
     info["height"] = img.shape[0]
     info["width"] = img.shape[1]
     info["channel"] = img.shape[2]
     return info
 
 
+def image_heads(paths, workers=None):  # @public
+    # Header-only probe of many files. Unreadable or unknown files give None.
+    def task(path):
+        try:
+            return probe_file(path)
+        except OSError:
+            return None
+
+    return list(_thread_pool(workers).map(task, paths))
+
+
+def image_head_dir(entry, workers=None):  # @public
+    paths = []
+    for root, dirs, files in os.walk(entry):
+        for f in files:
+            if is_image_ext(f):
+                paths.append(os.path.join(root, f))
+    paths.sort()
+    return dict(zip(paths, image_heads(paths, workers)))
+
+
 def generate_colors(C=200):  # @public
     color_table = []
     color_table.append((0, 0, 255))
@@ -371,3 +620,43 @@ def draw_box(image, box, color, caption=None, fontScale=0.5):  # @public
         c3 = (int(c1[0] + t_size[0]), int(c1[1] - t_size[1] - 3))
         cv2.rectangle(img=image, pt1=c1, pt2=c3, color=cr, thickness=-1)  # filled
         cv2.putText(image, caption, (int(box[0]), int(box[1]) - 2), cv2.FONT_HERSHEY_SIMPLEX, fontScale, (0, 0, 0), box_thick // 2, lineType=cv2.LINE_AA)
+
+
+_COLOR_TUPLES = [(int(c[0]), int(c[1]), int(c[2])) for c in COLOR_TABLE]
+
+
+@functools.lru_cache(maxsize=4096)
+def _text_size(caption, font_scale, thickness):
+    return cv2.getTextSize(caption, 0, font_scale, thickness=thickness)[0]
+
+
+def draw_boxes(image, boxes, class_ids, scores=None, captions=None, fontScale=0.5):  # @public
+    # boxes: (N, 4) x1,y1,x2,y2. class_ids: (N,) index into COLOR_TABLE.
+    # captions: list of N strings (or None). When only scores are given the caption is the score.
+    if isinstance(image, np.ndarray) is False: raise Exception("image must be numpy.")
+    if image.dtype != np.uint8: raise Exception("image dtype must be np.uint8.")
+    boxes = np.asarray(boxes)
+    n = len(boxes)
+    if n == 0:
+        return image
+    if boxes.ndim != 2 or boxes.shape[1] != 4:
+        raise Exception("boxes must be (N, 4). Invalid shape:" + str(boxes.shape))
+    boxes = boxes.astype(np.int32).tolist()
+    colors = np.asarray(class_ids, dtype=np.int64) % len(_COLOR_TUPLES)
+    colors = colors.tolist()
+    if captions is None and scores is not None:
+        captions = ["%.2f" % s for s in np.asarray(scores, dtype=np.float32).tolist()]
+    image_h = image.shape[0]
+    image_w = image.shape[1]
+    box_thick = int(0.6 * (image_h + image_w) / 600.0)
+    text_thick = box_thick // 2
+    for i in range(n):
+        x1, y1, x2, y2 = boxes[i]
+        cr = _COLOR_TUPLES[colors[i]]
+        cv2.rectangle(image, (x1, y1), (x2, y2), cr, box_thick)
+        if captions is not None and captions[i]:
+            caption = captions[i]
+            t_size = _text_size(caption, fontScale, text_thick)
+            cv2.rectangle(image, (x1, y1), (x1 + t_size[0], y1 - t_size[1] - 3), cr, -1)  # filled
+            cv2.putText(image, caption, (x1, y1 - 2), cv2.FONT_HERSHEY_SIMPLEX, fontScale, (0, 0, 0), text_thick, lineType=cv2.LINE_AA)
+    return image
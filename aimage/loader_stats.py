@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+import collections
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+# Stage timers of the loaders. Workers (threads or processes) collect their spans in a plain list with
+# mark() and hand it back with their result, the consumer merges them into LoaderStats.
+# perf_counter_ns is CLOCK_MONOTONIC on Linux, so spans of worker processes share the consumer's time base.
+
+RESERVOIR = 10000
+MAX_TRACE_EVENTS = 1000000
+
+
+def clock(spans):
+    # Start time of the first stage, 0 when spans is None (disabled).
+    if spans is None:
+        return 0
+    return time.perf_counter_ns()
+
+
+def mark(spans, stage, t0):
+    # Appends the stage that started at t0 and returns the start of the next one.
+    if spans is None:
+        return 0
+    t1 = time.perf_counter_ns()
+    spans.append((stage, t0, t1 - t0, os.getpid(), threading.get_ident()))
+    return t1
+
+
+class LoaderStats:
+    def __init__(self, trace=False):
+        self.trace = trace
+        self.reset()
+
+    def reset(self):
+        self.durations = collections.defaultdict(lambda: collections.deque(maxlen=RESERVOIR))
+        self.counts = collections.Counter()
+        self.totals = collections.Counter()
+        self.events = []
+        self.samples = 0
+        self.batches = 0
+        self.first_ns = None
+        self.last_ns = None
+        self.queue = collections.deque(maxlen=RESERVOIR)
+
+    def add_spans(self, spans):
+        if spans is None:
+            return
+        for stage, t0, dur, pid, tid in spans:
+            self.durations[stage].append(dur)
+            self.counts[stage] += 1
+            self.totals[stage] += dur
+            if self.trace and len(self.events) < MAX_TRACE_EVENTS:
+                self.events.append({"name": stage, "ph": "X", "ts": t0 / 1000.0, "dur": dur / 1000.0, "pid": pid, "tid": tid})
+
+    def add(self, stage, t0):
+        # Consumer side span from t0 to now.
+        spans = []
+        mark(spans, stage, t0)
+        self.add_spans(spans)
+        return spans[0][1] + spans[0][2]
+
+    def batch(self, t0, samples, q, output_buffer):
+        # One delivered batch: throughput window and the queue depths at delivery.
+        now = time.perf_counter_ns()
+        if self.first_ns is None:
+            self.first_ns = t0
+        self.last_ns = now
+        self.samples += samples
+        self.batches += 1
+        self.queue.append((q, output_buffer))
+        if self.trace and len(self.events) < MAX_TRACE_EVENTS:
+            self.events.append({"name": "queue", "ph": "C", "ts": now / 1000.0, "pid": os.getpid(), "args": {"q": q, "output_buffer": output_buffer}})
+
+    def summary(self):
+        stages = {}
+        for stage in self.durations:
+            d = np.array(self.durations[stage], dtype=np.float64) / 1e6
+            stages[stage] = {
+                "count": self.counts[stage],
+                "total_ms": self.totals[stage] / 1e6,
+                "mean_ms": float(d.mean()) if len(d) else 0.0,
+                "p50_ms": float(np.percentile(d, 50)) if len(d) else 0.0,
+                "p99_ms": float(np.percentile(d, 99)) if len(d) else 0.0,
+            }
+        elapsed = (self.last_ns - self.first_ns) / 1e9 if self.first_ns is not None else 0.0
+        queue = np.array(self.queue, dtype=np.float64).reshape(-1, 2)
+        return {
+            "samples": self.samples,
+            "batches": self.batches,
+            "elapsed_s": elapsed,
+            "throughput": self.samples / elapsed if elapsed > 0 else 0.0,
+            "stages": stages,
+            "queue": {
+                "q": int(queue[-1, 0]) if len(queue) else 0,
+                "q_mean": float(queue[:, 0].mean()) if len(queue) else 0.0,
+                "q_max": int(queue[:, 0].max()) if len(queue) else 0,
+                "output_buffer": int(queue[-1, 1]) if len(queue) else 0,
+                "output_buffer_mean": float(queue[:, 1].mean()) if len(queue) else 0.0,
+                "output_buffer_max": int(queue[:, 1].max()) if len(queue) else 0,
+            },
+        }
+
+    def export_trace(self, path):
+        # Chrome trace event format, open with chrome://tracing or Perfetto.
+        with open(path, "w") as fp:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, fp)
+        return path
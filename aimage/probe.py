@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+import struct
+
+HEAD_READ_SIZE = 4096
+
+_JPEG_SOF_MARKERS = (0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF)
+_PNG_CHANNELS = {0: 1, 2: 3, 3: 3, 4: 2, 6: 4}
+
+
+class _Reader:
+    # Random access over a buffer or a file. Files are only read around the header.
+    def __init__(self, data=None, fp=None):
+        self.fp = fp
+        if data is not None:
+            self.head = memoryview(data).cast("B")
+        else:
+            self.head = memoryview(fp.read(HEAD_READ_SIZE))
+
+    def read(self, offset, size):
+        if offset + size <= len(self.head) or self.fp is None:
+            return bytes(self.head[offset:offset + size])
+        self.fp.seek(offset)
+        return self.fp.read(size)
+
+
+def _jpeg(r):
+    i = 2
+    while True:
+        b = r.read(i, 10)
+        if len(b) < 4 or b[0] != 0xFF:
+            return None
+        m = b[1]
+        if m == 0xFF:
+            i += 1
+            continue
+        if m == 0x01 or 0xD0 <= m <= 0xD9:
+            i += 2
+            continue
+        if m in _JPEG_SOF_MARKERS:
+            if len(b) < 10:
+                return None
+            h, w = struct.unpack(">HH", b[5:9])
+            return {"type": "jpeg", "width": w, "height": h, "channel": b[9]}
+        i += 2 + struct.unpack(">H", b[2:4])[0]
+
+
+def _png(r):
+    b = r.read(12, 14)
+    if len(b) < 14 or b[0:4] != b"IHDR":
+        return None
+    w, h = struct.unpack(">II", b[4:12])
+    return {"type": "png", "width": w, "height": h, "channel": _PNG_CHANNELS.get(b[13], 3)}
+
+
+def _gif(r):
+    b = r.read(6, 4)
+    if len(b) < 4:
+        return None
+    w, h = struct.unpack("<HH", b)
+    return {"type": "gif", "width": w, "height": h, "channel": 3}
+
+
+def _tiff(r, endian):
+    b = r.read(4, 4)
+    if len(b) < 4:
+        return None
+    ifd = struct.unpack(endian + "I", b)[0]
+    b = r.read(ifd, 2)
+    if len(b) < 2:
+        return None
+    n = struct.unpack(endian + "H", b)[0]
+    entries = r.read(ifd + 2, n * 12)
+    tags = {}
+    for k in range(len(entries) // 12):
+        tag, typ = struct.unpack(endian + "HH", entries[k * 12:k * 12 + 4])
+        if typ == 3:  # SHORT
+            v = struct.unpack(endian + "H", entries[k * 12 + 8:k * 12 + 10])[0]
+        elif typ == 4:  # LONG
+            v = struct.unpack(endian + "I", entries[k * 12 + 8:k * 12 + 12])[0]
+        else:
+            continue
+        tags[tag] = v
+    if 256 not in tags or 257 not in tags:
+        return None
+    return {"type": "tiff", "width": tags[256], "height": tags[257], "channel": tags.get(277, 1)}
+
+
+def _webp(r):
+    b = r.read(12, 18)
+    if len(b) < 18:
+        return None
+    chunk = b[0:4]
+    if chunk == b"VP8 ":
+        if b[11:14] != b"\x9d\x01\x2a":
+            return None
+        w, h = struct.unpack("<HH", b[14:18])
+        return {"type": "webp", "width": w & 0x3FFF, "height": h & 0x3FFF, "channel": 3}
+    if chunk == b"VP8L":
+        if b[8] != 0x2F:
+            return None
+        v = struct.unpack("<I", b[9:13])[0]
+        return {"type": "webp", "width": (v & 0x3FFF) + 1, "height": ((v >> 14) & 0x3FFF) + 1, "channel": 4 if (v >> 28) & 1 else 3}
+    if chunk == b"VP8X":
+        w = int.from_bytes(b[12:15], "little") + 1
+        h = int.from_bytes(b[15:18], "little") + 1
+        return {"type": "webp", "width": w, "height": h, "channel": 4 if b[8] & 0x10 else 3}
+    return None
+
+
+def _probe(r):
+    b = r.read(0, 12)
+    if b[0:2] == b"\xff\xd8":
+        return _jpeg(r)
+    if b[0:8] == b"\x89PNG\r\n\x1a\n":
+        return _png(r)
+    if b[0:6] in (b"GIF87a", b"GIF89a"):
+        return _gif(r)
+    if b[0:4] == b"II*\x00":
+        return _tiff(r, "<")
+    if b[0:4] == b"MM\x00*":
+        return _tiff(r, ">")
+    if b[0:4] == b"RIFF" and b[8:12] == b"WEBP":
+        return _webp(r)
+    return None
+
+
+def probe_buffer(data):  # @public
+    # {"type", "width", "height", "channel"} from the header of an encoded image, or None.
+    try:
+        return _probe(_Reader(data=data))
+    except struct.error:
+        return None
+
+
+def probe_file(path):  # @public
+    # Same as probe_buffer but only reads the first few KB (plus the few segments it has to skip to).
+    with open(path, "rb") as fp:
+        try:
+            return _probe(_Reader(fp=fp))
+        except struct.error:
+            return None
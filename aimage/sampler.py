@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+import numpy as np
+
+_M1 = np.uint64(0x9E3779B97F4A7C15)
+_M2 = np.uint64(0xBF58476D1CE4E5B9)
+_M3 = np.uint64(0x94D049BB133111EB)
+
+
+class LazyPermutation:
+    # Seeded bijection of range(n) computed per index (4 round Feistel network plus cycle walking),
+    # so a shuffled epoch needs no O(n) permutation array.
+    def __init__(self, n, seed):
+        self.n = n
+        bits = max(2, int(max(n - 1, 1)).bit_length())
+        bits += bits & 1
+        self.half = np.uint64(bits // 2)
+        self.mask = np.uint64((1 << (bits // 2)) - 1)
+        self.keys = np.random.SeedSequence(seed).generate_state(4, dtype=np.uint64)
+
+    def round(self, r, k):
+        z = (r + k) * _M1
+        z ^= z >> np.uint64(31)
+        z *= _M2
+        z ^= z >> np.uint64(29)
+        z *= _M3
+        return (z ^ (z >> np.uint64(32))) & self.mask
+
+    def encrypt(self, x):
+        left = x >> self.half
+        right = x & self.mask
+        for k in self.keys:
+            left, right = right, left ^ self.round(right, k)
+        return (left << self.half) | right
+
+    def __call__(self, idx):
+        # idx: int array of positions < n. Values outside range(n) are encrypted again until they land inside.
+        x = self.encrypt(np.asarray(idx, dtype=np.uint64))
+        out = x >= np.uint64(self.n)
+        while out.any():
+            x[out] = self.encrypt(x[out])
+            out = x >= np.uint64(self.n)
+        return x.astype(np.int64)
+
+
+class BalancedSampler:
+    # data_align without the duplicated list. Class k holds vlen_k samples and is stretched to
+    # tlen_k = vlen_k + int((vmax - vlen_k) * data_align) virtual positions; virtual position x of the
+    # class maps to its sample x % vlen_k. Memory is O(N), a position costs one searchsorted over classes.
+    # The virtual order (classes in first appearance order, samples in input order) matches the old list.
+    def __init__(self, items, keys, data_align=0):
+        self.items = items
+        keys = np.asarray(keys)
+        n = len(items)
+        if data_align > 0 and n > 0:
+            uniq, first, codes = np.unique(keys, return_index=True, return_inverse=True)
+            rank = np.argsort(np.argsort(first))
+            codes = rank[codes.reshape(-1)]
+            self.members = np.argsort(codes, kind="stable")
+            self.vlens = np.bincount(codes, minlength=len(uniq))
+            vmax = self.vlens.max()
+            self.tlens = self.vlens + ((vmax - self.vlens) * data_align).astype(np.int64)
+        else:
+            self.members = np.arange(n)
+            self.vlens = np.array([n] if n else [], dtype=np.int64)
+            self.tlens = self.vlens.copy()
+        self.starts = np.concatenate(([0], np.cumsum(self.vlens)[:-1])).astype(np.int64) if len(self.vlens) else self.vlens
+        self.ends = np.cumsum(self.tlens)
+        self.total = int(self.ends[-1]) if len(self.ends) else 0
+
+    def __len__(self):
+        return self.total
+
+    def sample_index(self, positions):
+        # Virtual positions -> index into items.
+        positions = np.asarray(positions, dtype=np.int64)
+        k = np.searchsorted(self.ends, positions, side="right")
+        x = positions - (self.ends[k] - self.tlens[k])
+        return self.members[self.starts[k] + x % self.vlens[k]]
+
+    def epoch(self, seed=None, rank=0, world_size=1):
+        return EpochView(self, LazyPermutation(self.total, seed) if seed is not None else None, rank, world_size)
+
+
+class EpochView:
+    # One epoch of one rank: the stride rank::world_size of the (permuted) virtual positions.
+    # The tail that does not divide by world_size is dropped, so ranks never share a sample position.
+    # Slicing returns a list of items, like the list it replaces.
+    def __init__(self, sampler, permutation, rank=0, world_size=1):
+        self.sampler = sampler
+        self.permutation = permutation
+        self.rank = rank
+        self.world_size = world_size
+        self.length = len(sampler) // world_size
+
+    def __len__(self):
+        return self.length
+
+    def indices(self, start, stop):
+        # Item indices of epoch positions [start, stop).
+        positions = self.rank + np.arange(start, stop, dtype=np.int64) * self.world_size
+        if self.permutation is not None:
+            positions = self.permutation(positions)
+        return self.sampler.sample_index(positions)
+
+    def items_at(self, indices):
+        items = self.sampler.items
+        return [items[j] for j in indices.tolist()]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            r = range(self.length)[i]
+            if r.step != 1:
+                return [self[k] for k in r]
+            return self.items_at(self.indices(r.start, r.stop))
+        if i < 0:
+            i += self.length
+        if i < 0 or i >= self.length:
+            raise IndexError(i)
+        return self.items_at(self.indices(i, i + 1))[0]
+
+    def __iter__(self):
+        for start in range(0, self.length, 4096):
+            yield from self[start:start + 4096]
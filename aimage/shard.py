@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+import json
+import mmap
+import os
+
+import cv2
+import numpy as np
+from aimage.img import _from_bgr, _resize_into
+
+SHARD_BYTES = 1 << 30
+
+_readers = {}
+
+
+class ShardWriter:
+    # Packs pre-resized samples into a few large files, so an epoch is a handful of sequential reads
+    # instead of one open() per image.
+    #  - <path>/shard-NNNNN.bin  samples back to back, HWC uint8 BGR pixels ("raw") or encoded images ("jpg").
+    #  - <path>/records.npy      (N, 3) int64: shard number, byte offset and byte length of every sample.
+    #  - <path>/signals.npy      (N, C) float32 signal vector of every sample.
+    #  - <path>/meta.json        format, sample shape, classes, shard files and the source path of every sample.
+    def __init__(self, path, shape, format="raw", quality=95, shard_bytes=SHARD_BYTES):
+        if format not in ("raw", "jpg"): raise Exception("format must be raw or jpg. Invalid arg:" + str(format))
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.shape = tuple(shape)
+        self.format = format
+        self.quality = quality
+        self.shard_bytes = shard_bytes
+        self.shards = []
+        self.fp = None
+        self.records = []
+        self.signals = []
+        self.file_paths = []
+
+    def next_shard(self):
+        if self.fp is not None:
+            self.fp.close()
+        name = "shard-%05d.bin" % (len(self.shards), )
+        self.shards.append(name)
+        self.fp = open(os.path.join(self.path, name), "wb")
+
+    def write(self, img, signals, file_path):
+        # img: HWC uint8 BGR image of `shape`.
+        if self.format == "jpg":
+            data = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, self.quality])[1]
+        else:
+            data = np.ascontiguousarray(img)
+        data = memoryview(data).cast("B")
+        if self.fp is None or (self.fp.tell() > 0 and self.fp.tell() + len(data) > self.shard_bytes):
+            self.next_shard()
+        self.records.append((len(self.shards) - 1, self.fp.tell(), len(data)))
+        self.fp.write(data)
+        self.signals.append(signals)
+        self.file_paths.append(file_path)
+
+    def close(self, classes):
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+        np.save(os.path.join(self.path, "records.npy"), np.array(self.records, dtype=np.int64).reshape(-1, 3))
+        np.save(os.path.join(self.path, "signals.npy"), np.array(self.signals, dtype=np.float32).reshape(len(self.records), len(classes)))
+        meta = {"format": self.format, "shape": list(self.shape), "classes": classes, "shards": self.shards, "file_paths": self.file_paths}
+        with open(os.path.join(self.path, "meta.json"), "w") as fp:
+            json.dump(meta, fp)
+
+
+class ShardReader:
+    # Memory-maps the shards written by ShardWriter. Any sample is one slice of a mapping, so shuffled
+    # access costs a page fault instead of an open(). sequential=False hints the kernel for random access.
+    def __init__(self, path, sequential=True):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as fp:
+            meta = json.load(fp)
+        self.format = meta["format"]
+        self.shape = tuple(meta["shape"])
+        self.classes = meta["classes"]
+        self.file_paths = meta["file_paths"]
+        self.records = np.load(os.path.join(path, "records.npy"))
+        self.signals = np.load(os.path.join(path, "signals.npy"))
+        self.maps = []
+        for name in meta["shards"]:
+            with open(os.path.join(path, name), "rb") as fp:
+                m = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            if hasattr(m, "madvise"):
+                m.madvise(mmap.MADV_SEQUENTIAL if sequential else mmap.MADV_RANDOM)
+            self.maps.append(m)
+
+    def __len__(self):
+        return len(self.records)
+
+    def record(self, i):
+        shard, offset, length = self.records[i]
+        return memoryview(self.maps[shard])[offset:offset + length]
+
+    def read(self, i):
+        # HWC uint8 BGR image. Raw records are a read-only view of the mapping.
+        buf = np.frombuffer(self.record(i), dtype=np.uint8)
+        if self.format == "raw":
+            return buf.reshape(self.shape)
+        return cv2.imdecode(buf, cv2.IMREAD_GRAYSCALE if self.shape[2] == 1 else cv2.IMREAD_COLOR)
+
+    def read_into(self, i, dst, color_order=None):
+        img = self.read(i)
+        if img.shape != dst.shape:
+            _resize_into(img, dst, cv2.INTER_AREA)
+            img = dst
+        _from_bgr(img, color_order, dst=dst)
+
+    def close(self):
+        for m in self.maps:
+            m.close()
+        self.maps = []
+
+
+def shard_reader(path, sequential=True):
+    # One reader per process and shard directory, so loader workers map the shards only once.
+    key = (path, sequential)
+    if key not in _readers:
+        _readers[key] = ShardReader(path, sequential)
+    return _readers[key]
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+import weakref
+
+import numpy as np
+from easydict import EasyDict as edict
+
+_attached = {}
+
+
+def _release(shm):
+    try:
+        shm.close()
+        shm.unlink()
+    except FileNotFoundError:
+        pass
+
+
+class SampleRing:
+    # Preallocated NHWC ring of sample slots. Loader workers write decoded samples straight into
+    # their slot and the consumer slices whole batches out of it without stacking.
+    # With shared=True the ring lives in multiprocessing.shared_memory so process workers can write to it.
+    def __init__(self, slots, shape, dtype=np.uint8, shared=False):
+        self.slots = slots
+        self.shape = (slots, ) + tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.shm = None
+        if shared:
+            # Python 3.8+. Imported here so thread workers keep working on older versions.
+            from multiprocessing import shared_memory
+            nbytes = max(1, int(np.prod(self.shape)) * self.dtype.itemsize)
+            self.shm = shared_memory.SharedMemory(create=True, size=nbytes)
+            self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+            self._finalizer = weakref.finalize(self, _release, self.shm)
+        else:
+            self.array = np.empty(self.shape, dtype=self.dtype)
+
+    def handle(self):
+        # What a worker needs to reach the ring: the array itself for threads, the shm name for processes.
+        if self.shm is None:
+            return self.array
+        return (self.shm.name, self.shape, self.dtype.str)
+
+    def slot(self, position):
+        return position % self.slots
+
+    def take(self, position, n):
+        # n consecutive samples starting at a stream position. A view unless the range wraps the ring end.
+        s = position % self.slots
+        if s + n <= self.slots:
+            return self.array[s:s + n]
+        return np.concatenate((self.array[s:], self.array[0:n - (self.slots - s)]))
+
+    def close(self):
+        if self.shm is not None:
+            self.array = None
+            self._finalizer()
+            self.shm = None
+
+
+def attach(handle):
+    # Worker side of SampleRing.handle(). Shared memory segments are attached once per process.
+    if isinstance(handle, np.ndarray):
+        return handle
+    name, shape, dtype = handle
+    if name not in _attached:
+        # Pool workers share the parent's resource tracker, so the owner's unlink stays the only one.
+        from multiprocessing import shared_memory
+        shm = shared_memory.SharedMemory(name=name)
+        _attached[name] = (shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf))
+    return _attached[name][1]
+
+
+def collate(images, layout="nhwc", dtype="float32", scale=1.0):
+    # NHWC samples -> batch array of the given layout and dtype, written in one pass (the transpose is fused
+    # into the copy). Float dtypes are multiplied by scale. NHWC in the source dtype is returned as is.
+    if layout not in ("nhwc", "nchw"): raise Exception("layout must be nhwc or nchw. Invalid arg:" + str(layout))
+    dtype = np.dtype(dtype)
+    if layout == "nchw":
+        images = images.transpose(0, 3, 1, 2)
+    elif dtype == images.dtype:
+        return images
+    out = np.empty(images.shape, dtype=dtype)
+    if dtype.kind == "f" and scale != 1.0:
+        np.multiply(images, np.float32(scale), out=out)
+    else:
+        np.copyto(out, images, casting="unsafe")
+    return out
+
+
+class Batch(edict):
+    # Batch of get_batch(). The images export without a copy: DLPack (torch.from_dlpack(b)),
+    # the buffer protocol (memoryview(b), Python 3.12+) and np.asarray(b).
+    def __dlpack__(self, **kwargs):
+        return self.images.__dlpack__(**kwargs)
+
+    def __dlpack_device__(self):
+        return self.images.__dlpack_device__()
+
+    def __buffer__(self, flags):
+        return memoryview(self.images)
+
+    def __array__(self, dtype=None, copy=None):
+        return np.array(self.images, dtype=dtype, copy=copy)
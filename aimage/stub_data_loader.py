@@ -1,12 +1,12 @@
 #!/usr/bin/env python3
 _dopen = open
-import glob
+import asyncio
+import concurrent.futures
 import json
 import os
 import pathlib
 import random
 import sys
-import time
 
 import cv2
 import numpy as np
@@ -15,6 +15,75 @@ from aimage.head import *
 from aimage.img import *
 from aimage.ui import *
 from easydict import EasyDict as edict
+from aimage.img import _from_bgr, _reduced_decode_flag, _resize_into
+from aimage.shared_batch import Batch, SampleRing, attach, collate
+from aimage.dataset_index import DatasetIndex
+from aimage import image_cache
+from aimage.image_cache import ImageCache, cache_slot, submit_after
+from aimage.shard import SHARD_BYTES, ShardWriter, shard_reader
+from aimage.augment import Augmenter, mix_signals
+from aimage.sampler import BalancedSampler
+from aimage.loader_stats import LoaderStats, clock, mark
+
+
+# Runs in a loader worker (thread or process), so it must stay a picklable module level function.
+# Samples are resized straight into their ring slot and augmented there (the cache keeps them unaugmented),
+# only the mixup table and the stage spans (profile=True) travel back.
+# tasks: [(image_path, cached location to copy from, cache location to fill)]
+def _load_stream(tasks, target_size, color_order, interpolation, ring, slot, cache, augmenter, seed, profile):
+    out = attach(ring)
+    spans = [] if profile else None
+    t = clock(spans)
+    for k, (image_path, src, dst) in enumerate(tasks):
+        if src is not None:
+            out[slot + k] = cache_slot(cache, src)
+            t = mark(spans, "cache", t)
+            continue
+        # load_image() split in its stages.
+        nb = np.fromfile(image_path, dtype=np.uint8)
+        t = mark(spans, "read", t)
+        img = _from_bgr(cv2.imdecode(nb, _reduced_decode_flag(nb, target_size[0:2], grayscale=target_size[2] == 1)), color_order)
+        if img is None:
+            raise Exception("Invalid image file or invalid path. \"%s\"" % (image_path, ))
+        t = mark(spans, "decode", t)
+        if dst is None:
+            _resize_into(img, out[slot + k], interpolation)
+        else:
+            cached = cache_slot(cache, dst)
+            _resize_into(img, cached, interpolation)
+            out[slot + k] = cached
+        t = mark(spans, "resize", t)
+    return _augment(augmenter, out[slot:slot + len(tasks)], seed, spans, t)
+
+
+def _read_shard_stream(shard_path, ids, color_order, ring, slot, sequential, augmenter, seed, profile):
+    out = attach(ring)
+    spans = [] if profile else None
+    t = clock(spans)
+    shards = shard_reader(shard_path, sequential)
+    for k, i in enumerate(ids):
+        shards.read_into(i, out[slot + k], color_order)
+        t = mark(spans, "shard_read", t)
+    return _augment(augmenter, out[slot:slot + len(ids)], seed, spans, t)
+
+
+def _augment(augmenter, images, seed, spans, t):
+    if augmenter is None:
+        return None, spans
+    mix = augmenter(images, np.random.default_rng(seed))
+    mark(spans, "augment", t)
+    return mix, spans
+
+
+def _load_resized(image_paths, target_size, interpolation):
+    out = np.empty((len(image_paths), target_size[1], target_size[0], target_size[2]), dtype=np.uint8)
+    for k, image_path in enumerate(image_paths):
+        nb = np.fromfile(image_path, dtype=np.uint8)
+        img = cv2.imdecode(nb, _reduced_decode_flag(nb, target_size[0:2], grayscale=target_size[2] == 1))
+        if img is None:
+            raise Exception("Invalid image file or invalid path. \"%s\"" % (image_path, ))
+        _resize_into(img, out[k], interpolation)
+    return out
 
 
 # Stub
@@ -26,15 +95,34 @@ class AggressiveImageGenerator:
          - shuffle: True / False # shuffle data
          - entry: <input data path>
          - label_path: <output label path> for resume
+         - index_path: <dataset index path> # persistent file listing, only changed directories are rescanned on restart
+         - scan_workers: None # threads walking the top-level directories (None: ThreadPoolExecutor default)
+         - shard_path: <shard directory> # read memory-mapped shards written by export_shards() instead of entry
+         - rank: 0 # this process in distributed training
+         - world_size: 1 # every rank reads a disjoint, equally long slice of the epoch permutation
+         - seed: None # seeds the epoch permutations and augmentations. Defaults to 0 when world_size > 1
+         - index_ttl: 60 # seconds. With world_size > 1, ranks reuse the index scan another rank made within index_ttl
          - loss: "tree" / "list" 
-         - target_size: (w,h,c) # shape
+         - target_size: (w,h,c) # shape. c is 3 or 1 (decoded as grayscale)
          - data_align: 0.0~1.0 # adjust data length for each classes
          - rescale: 1/255.0
-         - data_aug_params: dict{}
+         - data_aug_params: dict{} # keys of make_full_aug_params(), applied by aimage.augment.Augmenter in the loader workers
          - progress_bar: True / False
          - batch_size: 128
+         - color_order: "rgb" / "bgr" # channel order of images. Default is aimage.COLOR_ORDER
+         - workers: os.cpu_count() # loader workers. 0 loads synchronously in the caller
+         - worker_type: "thread" / "process"
+         - prefetch: 1024 # max samples loaded (or in flight) ahead of consumption
+         - overlap_epochs: True # start loading the next epoch while the last batches of the current one are consumed
+         - stats: False # per-stage timers and counters, see get_stats()
+         - trace: False # also keep Chrome trace events of worker and consumer threads, see export_trace()
+         - output_dtype: "float32" / "float16" / "uint8" # float types fuse the rescale into the collate copy.
+                         uint8 skips rescale, in nhwc it is a view of the sample ring that stays valid until the next batch.
+         - layout: "nhwc" / "nchw" # images layout of get_batch(). nchw is written by the collate copy, no later transpose.
         """
 
+        if "entry" not in kwargs and kwargs.get("shard_path"):
+            kwargs["entry"] = kwargs["shard_path"]
         entry = kwargs["entry"]
         if entry == "/":
             print("\033[0;31m", "Error: Can't use root:", entry, "\033[0m")
@@ -56,11 +144,37 @@ class AggressiveImageGenerator:
         self.shuffle = False
         self.batch_size = 128
         self.label_path = "output.label"
+        self.index_path = None
+        self.scan_workers = None
+        self.shard_path = None
+        self.rank = 0
+        self.world_size = 1
+        self.seed = None
+        self.index_ttl = 60
         self.target_size = (256, 256, 3)
         self.rescale = 1 / 255.0
         self.data_aug_params = {"resize_width": 256, "resize_height": 256}
+        self.color_order = None
+        self.workers = os.cpu_count() or 1
+        self.worker_type = "thread"
+        self.prefetch = 1024
+        self.overlap_epochs = True
+        self.output_dtype = "float32"
+        self.layout = "nhwc"
+        self.stats = False
+        self.trace = False
 
         self.set(**kwargs)
+        self.loader_stats = LoaderStats(self.trace) if self.stats or self.trace else None
+        if self.world_size > 1:
+            if self.seed is None:
+                self.seed = 0
+            if self.index_path is None:
+                self.index_path = self.label_path + ".index"
+        if len(self.target_size) != 3 or self.target_size[2] not in (1, 3):
+            raise Exception("target_size must be (w, h, 3) or (w, h, 1). Invalid arg:" + str(self.target_size))
+        if self.rank < 0 or self.rank >= self.world_size:
+            raise Exception("rank(%d) must be in [0, world_size(%d))." % (self.rank, self.world_size))
 
         if self.verbose:
             print(kwargs)
@@ -73,6 +187,21 @@ class AggressiveImageGenerator:
         self.STREAM_BATCH = 16
 
         self.label_name = os.path.basename(self.entry)
+        self.index = None
+        self.shards = None
+        t = clock([] if self.loader_stats else None)
+        if self.shard_path:
+            self.shards = shard_reader(self.shard_path, self.shuffle is False)
+        else:
+            self.index = DatasetIndex(self.entry, self.index_path, workers=self.scan_workers)
+            if self.world_size > 1:
+                self.index.shared_scan(self.index_ttl)
+            else:
+                self.index.scan()
+            if self.verbose:
+                print("Rescanned directories:", len(self.index.rescanned), "/", len(self.index.dirs))
+        if self.loader_stats:
+            self.loader_stats.add("listing", t)
         self.build_classes()
 
         if self.verbose:
@@ -88,10 +217,22 @@ class AggressiveImageGenerator:
         for k in data_aug_params:
             data_aug_params[k] = str(data_aug_params[k])
         self.data_aug_params = data_aug_params
-
-        self.stub_buffer = []
+        self.interpolation = interpolation_flag(data_aug_params["resize_interpolation"])
+        self.augmenter = Augmenter(data_aug_params, self.color_order)
+        if self.augmenter.active is False:
+            self.augmenter = None
+
+        self.executor = None
+        self.ring = None
+        self.ring_offset = 0
+        self.cache = None
+        self.pending_streams = []
         self.output_buffer = []
         self.datas = None
+        self.next_epoch = None
+        self.sampler = None
+        self.epoch = -1
+        self.rng = random
         self.is_tree = self.loss == "tree"
         self.sync_reset()
 
@@ -133,74 +274,158 @@ class AggressiveImageGenerator:
             self.sync_reset()
             raise StopIteration()
 
+    def __aiter__(self):
+        return self.__iter__()
+
+    async def __anext__(self):
+        # Awaits the loader futures of the next batch without blocking the event loop, then collates.
+        for future in self.next_futures():
+            await asyncio.wrap_future(future)
+        try:
+            return self.__next__()
+        except StopIteration:
+            raise StopAsyncIteration()
+
+    def next_futures(self):
+        # Chunks the next get_batch() would wait for.
+        if self.total <= self.ite:
+            return []
+        self.fill_stream()
+        need = self.batch_size - len(self.output_buffer)
+        futures = []
+        for ds, future, keys, idx in self.pending_streams:
+            if need <= 0:
+                break
+            futures.append(future)
+            need -= len(ds)
+        return futures
+
+    def get_stats(self):
+        # {"samples", "batches", "elapsed_s", "throughput", "stages": {stage: {count, total_ms, mean_ms, p50_ms, p99_ms}},
+        #  "queue": {q, output_buffer (last), mean and max}}. Stages: listing, read, decode, resize, cache,
+        # shard_read, augment (workers), wait, collate (consumer).
+        if self.loader_stats is None: raise Exception("Create the generator with stats=True.")
+        return self.loader_stats.summary()
+
+    def export_trace(self, path):
+        if self.loader_stats is None or self.loader_stats.trace is False: raise Exception("Create the generator with trace=True.")
+        return self.loader_stats.export_trace(path)
+
+    def close(self):
+        self.drain()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+        if self.cache is not None:
+            self.cache.close()
+            self.cache = None
+
+    def drain(self):
+        # Drop queued chunks and wait for running ones, they still write into the ring.
+        pending = self.pending_streams + (self.next_epoch["pending"] if self.next_epoch is not None else [])
+        for ds, future, keys, idx in pending:
+            future.cancel()
+        concurrent.futures.wait([future for ds, future, keys, idx in pending])
+        for ds, future, keys, idx in pending:
+            self.release_cache(future, keys)
+        self.pending_streams = []
+        self.next_epoch = None
+        self.output_buffer = []
+        self.q = 0
+
     def sync_reset(self):
-        entry = self.entry
-        if self.datas is None:
-            self.datas = []
+        n = self.next_epoch
+        if n is not None and n["epoch"] == self.epoch + 1 and self.oindex == self.total and len(self.output_buffer) == 0:
+            # The whole epoch was consumed and the next one is already loading right behind it in the ring.
+            self.ring_offset += self.total
+            self.epoch = n["epoch"]
+            self.datas = n["datas"]
+            self.rng = n["rng"]
+            self.pending_streams = n["pending"]
+            self.next_epoch = None
+            self.total = len(self.datas)
+            self.iindex = n["iindex"]
+            self.oindex = 0
+            return
+        self.drain()
+        self.ring_offset += self.oindex
+        self.epoch += 1
+        if self.sampler is None:
             self.prebatch = None
             class_index_table = {}
-            table = {}
             for clazz in self.classes:
                 c = self.classes[clazz]
                 class_index_table[c["index"]] = {"name": clazz, "results": [], "total": 0}
-            for filename in pathlib.Path(entry).glob('**/*.jpg'):
-                filename = str(filename)
-                self.datas.append(filename)
-                signals = self.make_signal(self.entry, filename, self.classes)
+            if self.shards is not None:
+                # Samples are shard record numbers.
+                signals = self.shards.signals
                 if self.is_tree:
-                    signals *= self.signal_mask
-                idx_key = np.argmax(signals)
-                if idx_key not in table:
-                    table[idx_key] = []
-                table[idx_key].append(filename)
-                # if idx_key not in class_index_table:
-                #    class_index_table[idx_key] = {"name":self.get_name(idx_key),"results":[],"total":0}
-                class_index_table[idx_key]["total"] += 1
-            # Estimate Max
-            vmax = 0
-            for k in table:
-                v = table[k]
-                vlen = len(v)
-                if vlen > vmax:
-                    vmax = vlen
+                    signals = signals * self.signal_mask
+                file_keys = np.argmax(signals, axis=1) if len(signals) else np.zeros((0, ), dtype=np.int64)
+                items = range(len(self.shards))
+                self.signal_matrix = self.shards.signals.astype(np.float32)
+                self.signal_rows = np.arange(len(self.shards), dtype=np.int32)
+            else:
+                # Signals only depend on the directory, so classify directories once and gather per file.
+                # Batches gather signal rows by index: the D x C directory matrix and the directory of every file.
+                self.signal_matrix = self.index.dir_signals(self.classes, self.make_signal)
+                self.signal_rows = self.index.file_dirs
+                dir_signals = self.signal_matrix
+                if self.is_tree:
+                    dir_signals = dir_signals * self.signal_mask
+                file_keys = np.argmax(dir_signals, axis=1)[self.index.file_dirs] if len(self.index.dirs) else np.zeros((0, ), dtype=np.int64)
+                items = self.index.paths()
+            counts = np.bincount(file_keys, minlength=len(class_index_table))
+            for k in np.flatnonzero(counts).tolist():
+                class_index_table[k]["total"] = int(counts[k])
                 if self.verbose:
-                    print(self.get_name(k), ":", vlen)
+                    print(self.get_name(k), ":", counts[k])
+            vmax = int(counts.max()) if len(file_keys) else 0
             if self.verbose: print("Max => ", vmax)
-            # Make a data aligned table.
-            for k in table:
-                v = table[k]
-                vlen = len(v)
-                ns = []
-                tlen = vlen + int((vmax - vlen) * self.data_align)
-                for x in range(tlen):
-                    ns.append(v[x % vlen])
-                table[k] = ns
-            # Make a data aligned array.
-            new_datas = []
-            for k in table:
-                v = table[k]
-                vlen = len(v)
-                new_datas += v
+            # data_align stretches every class towards vmax by index arithmetic, nothing is duplicated.
+            self.sampler = BalancedSampler(items, file_keys, self.data_align)
+            self.class_ids = file_keys.astype(np.int32)
             if self.data_align > 0:
                 if self.verbose:
-                    print("Total", len(self.datas), "=>", vmax, "x", len(table), "=>", len(new_datas))
-                self.datas = new_datas
+                    print("Total", len(items), "=>", vmax, "x", len(self.sampler.vlens), "=>", len(self.sampler))
                 for i in class_index_table:
                     class_index_table[i]["total"] = vmax
-            self.total = len(self.datas)
             self.class_index_table = class_index_table
-        if self.shuffle:
-            random.shuffle(self.datas)
+        self.datas, self.rng = self.epoch_datas(self.epoch)
+        self.total = len(self.datas)
         self.iindex = 0
         self.oindex = 0
 
+    def epoch_datas(self, epoch):
+        # Every rank draws the same permutation for the epoch and takes its own stride of it.
+        # Without a seed the permutation is drawn from the global random module, as random.shuffle used to.
+        # Returns the epoch view and the generator of its augmentation seeds.
+        if self.seed is None:
+            seed = random.getrandbits(64) if self.shuffle else None
+            rng = random
+        else:
+            rng = random.Random("%d-%d-%d" % (self.seed, self.rank, epoch))
+            seed = [self.seed, epoch] if self.shuffle else None
+        return self.sampler.epoch(seed, self.rank, self.world_size), rng
+
+    def set_epoch(self, epoch):
+        # Restarts the stream at the given epoch, like torch DistributedSampler.set_epoch().
+        self.epoch = epoch - 1
+        self.sync_reset()
+
     def build_classes(self):
         j = {}
         try:
             j = json.loads(_dopen(self.label_path).read())
         except:
             pass
-        classes = self.make_class(entry=self.entry, loss=self.loss, class_dict=j)
+        if self.shards is not None:
+            classes = self.shards.classes
+        else:
+            classes = self.make_class(entry=self.entry, loss=self.loss, class_dict=j)
         self.label_json = json.dumps(classes)
 
         if os.path.exists(os.path.dirname(self.label_path)) is False:
@@ -228,94 +453,192 @@ class AggressiveImageGenerator:
     def get_classes(self):
         return self.clasess
 
-    def get_batch(self, batch_size=None):
+    def get_batch(self, batch_size=None, layout=None, dtype=None):
+        # layout / dtype: override the generator's layout / output_dtype for this batch.
+        # The returned Batch exports its images through __dlpack__ and the buffer protocol.
         if batch_size is None:
             batch_size = self.batch_size
+        if layout is None:
+            layout = self.layout
+        if dtype is None:
+            dtype = self.output_dtype
+        if batch_size > self.batch_size:
+            raise Exception("batch_size(%d) must be <= the generator batch_size(%d)." % (batch_size, self.batch_size))
+        t = clock([] if self.loader_stats else None)
         block = self.get_data_block(batch_size)
-        b = edict()
+        t_collate = clock([] if self.loader_stats else None)
+        b = Batch()
         b.images = []
         b.signals = []
+        b.class_ids = []
         b.points = None
         b.file_paths = []
         if block:
             for d in block:
-                b.images.append(d["image"])
-                b.signals.append(d["signals"])
                 b.file_paths.append(d["file_path"])
                 #d["points"])
-            b.images = np.array(b.images, dtype=np.float32)
-            b.signals = np.array(b.signals, dtype=np.float32)
-            if self.rescale != 1.0:
-                b.images *= self.rescale
+            # The block is the last len(block) samples of the stream, contiguous in the rings.
+            position = self.ring_offset + self.oindex - len(block)
+            b.images = collate(self.ring.take(position, len(block)), layout, dtype, self.rescale)
+            b.signals = np.array(self.signal_ring.take(position, len(block)))
+            b.class_ids = np.array(self.class_ring.take(position, len(block)))
+            if self.loader_stats:
+                self.loader_stats.add("collate", t_collate)
+                self.loader_stats.batch(t, len(block), self.q, len(self.output_buffer))
 
         return b
 
+    def submit(self, fn, *args):
+        if self.workers <= 0:
+            future = concurrent.futures.Future()
+            future.set_result(fn(*args))
+            return future
+        if self.executor is None:
+            if self.worker_type == "process":
+                self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+            elif self.worker_type == "thread":
+                self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="aimage-loader")
+            else:
+                raise Exception("worker_type must be thread or process. Invalid arg:" + str(self.worker_type))
+        return self.executor.submit(fn, *args)
+
+    def build_ring(self):
+        # prefetch samples ahead plus the batch the consumer holds, rounded up to whole batches.
+        bs = self.batch_size
+        slots = (self.prefetch + bs + bs - 1) // bs * bs
+        shape = (self.target_size[1], self.target_size[0], self.target_size[2])
+        shared = self.worker_type == "process" and self.workers > 0
+        self.ring = SampleRing(slots, shape, np.uint8, shared=shared)
+        self.signal_ring = SampleRing(slots, (self.signal_matrix.shape[1], ), np.float32)
+        self.class_ring = SampleRing(slots, (), np.int32)
+        self.ring_offset = 0
+        if self.cache is None and self.shards is None:
+            self.cache = ImageCache.create(shape, shared=shared)
+
+    def acquire_cache(self, ds):
+        # Returns the loader tasks, the (key, filled) pairs to release and the tasks waiting for a queued fill.
+        if self.cache is None:
+            return [(image_path, None, None) for image_path in ds], [], []
+        return self.cache.acquire_tasks(ds, [self.cache_key(image_path) for image_path in ds])
+
+    def cache_key(self, image_path):
+        # Stat at use time: a file rewritten in place keeps its directory mtime, so the index would not notice.
+        try:
+            st = os.stat(image_path)
+        except OSError:
+            # The loader reports the missing file.
+            return None
+        return (image_path, st.st_mtime_ns, st.st_size, tuple(self.target_size))
+
+    def release_cache(self, future, keys):
+        if self.cache is not None and len(keys) > 0:
+            self.cache.release(keys, ok=future.cancelled() is False and future.exception() is None)
+
+    def fill_stream(self):
+        # Keep workers busy up to `prefetch` samples ahead of the consumer.
+        if self.ring is None:
+            self.build_ring()
+        limit = self.ring.slots - self.batch_size
+        while self.iindex - self.oindex < limit and self.iindex < self.total:
+            slot = self.ring.slot(self.ring_offset + self.iindex)
+            dlen = min(self.STREAM_BATCH, self.total - self.iindex, self.ring.slots - slot, limit - (self.iindex - self.oindex))
+            self.pending_streams.append(self.submit_chunk(self.datas, self.iindex, dlen, slot, self.rng))
+            self.iindex += dlen
+        if self.overlap_epochs and self.iindex == self.total and self.iindex - self.oindex < limit:
+            self.fill_next_epoch(limit)
+
+    def fill_next_epoch(self, limit):
+        # Every chunk of this epoch is submitted: the next epoch continues the stream right after it,
+        # so its permutation and first chunks are ready when sync_reset() switches over.
+        n = self.next_epoch
+        if n is None:
+            datas, rng = self.epoch_datas(self.epoch + 1)
+            n = self.next_epoch = {"epoch": self.epoch + 1, "datas": datas, "rng": rng, "pending": [], "iindex": 0}
+        ahead = self.total - self.oindex
+        total = len(n["datas"])
+        while ahead + n["iindex"] < limit and n["iindex"] < total:
+            slot = self.ring.slot(self.ring_offset + self.total + n["iindex"])
+            dlen = min(self.STREAM_BATCH, total - n["iindex"], self.ring.slots - slot, limit - (ahead + n["iindex"]))
+            n["pending"].append(self.submit_chunk(n["datas"], n["iindex"], dlen, slot, n["rng"]))
+            n["iindex"] += dlen
+
+    def submit_chunk(self, datas, start, dlen, slot, rng):
+        # Epoch positions [start, start + dlen) into ring slots slot.., returns the pending_streams entry.
+        idx = datas.indices(start, start + dlen)
+        ds = datas.items_at(idx)
+        self.q += dlen
+        if self.shards is not None:
+            future = self.submit(_read_shard_stream, self.shard_path, ds, self.color_order, self.ring.handle(), slot, self.shuffle is False, self.augmenter, rng.getrandbits(64), self.loader_stats is not None)
+            return (ds, future, [], idx)
+        tasks, keys, waits = self.acquire_cache(ds)
+        cache = self.cache.handle() if self.cache is not None else None
+        # Images another queued chunk is still decoding into the cache (the next epoch overlapping this one)
+        # are copied once that chunk is done instead of being decoded twice.
+        future = submit_after(self.submit, waits, tasks, _load_stream, tasks, self.target_size, self.color_order, self.interpolation, self.ring.handle(), slot, cache, self.augmenter, rng.getrandbits(64), self.loader_stats is not None)
+        if self.cache is not None:
+            self.cache.submitted(keys, future)
+        return (ds, future, keys, idx)
+
     def get_data_block(self, batch_size):
         if self.total == 0:
             print("Zero length")
-            raise "Zero length"
-        while True:
-            if self.q < 1024:
-                if self.iindex < self.total:
-                    ds = self.datas[self.iindex:self.iindex + self.STREAM_BATCH]
-                    dlen = len(ds)
-                    self.q += dlen
-                    stream = list()
-                    # input   = dict()
-                    # input["data_aug_params"] = self.data_aug_params
-                    for image_path in ds:
-                        signals = self.make_signal(self.entry, image_path, self.classes)
-                        d = dict()
-                        d["image_path"] = image_path
-                        d["file_path"] = image_path
-                        d["image"] = cv2.resize(load_image(image_path), (self.target_size[0], self.target_size[1]), interpolation=cv2.INTER_AREA)
-
-                        # data_aug_params
-                        # {'entry': 'data/fruit/train', 'label_path': 'weights/fruit.mobilenet.categorical_crossentropy.label', 'loss': 'categorical_crossentropy',
-                        #     'target_size': (224, 224, 3), 'data_align': True, 'rescale': 0.00392156862745098, 'shuffle': True, 'data_aug_params': {'resize_width': 224, 'resize_height': 224}}
-
-                        d["signals"] = np.array(signals, dtype=np.float32)
-                        d["points_table"] = None
-                        stream.append(d)
-                    # input["stream"] = stream
-                    # //    {
-                    # //      params:{
-                    # //          data_aug_params:{}
-                    # //      },
-                    # //      stream: [{image_path:"",signals:[],points_table:[]},{},{},{},]
-                    # //    }
-                    self.stub_buffer += stream
-                    # native_module.async_image_loader_with_data_aug_input(str(hex(id(self))),input)
-                    self.iindex += dlen
-                else:
-                    # random.shuffle(self.datas)
-                    # self.iindex = 0
-                    break
-            else:
-                break
+            raise Exception("Zero length")
+        self.fill_stream()
         if self.iindex == self.oindex:
             return None
-        if len(self.output_buffer) >= batch_size or self.iindex == self.oindex + len(self.output_buffer):
-            buf = self.output_buffer[0:batch_size]
-            self.output_buffer = self.output_buffer[batch_size:]
-            self.oindex += len(buf)
-            return buf
-        while True:
-            #ret = native_module.async_image_loader_with_data_aug_output(str(hex(id(self))))
-            ret = self.stub_buffer
-            if ret is not None and len(ret) > 0:
-                self.q -= len(ret)
-                self.output_buffer += ret
-                self.stub_buffer = []
-                if len(self.output_buffer) >= batch_size or self.iindex == self.oindex + len(self.output_buffer):
-                    buf = self.output_buffer[0:batch_size]
-                    self.output_buffer = self.output_buffer[batch_size:]
-                    self.oindex += len(buf)
-                    return buf
-            else:
-                time.sleep(0.1)
-                if self.iindex == self.oindex:
-                    return None
+        while len(self.output_buffer) < batch_size and self.iindex != self.oindex + len(self.output_buffer):
+            # Blocks on the oldest chunk until its worker completes it, no polling.
+            ds, future, keys, idx = self.pending_streams.pop(0)
+            t = clock([] if self.loader_stats else None)
+            concurrent.futures.wait([future])
+            self.release_cache(future, keys)
+            mix, spans = future.result()
+            if self.loader_stats:
+                self.loader_stats.add("wait", t)
+                self.loader_stats.add_spans(spans)
+            self.q -= len(ds)
+            # Chunks never wrap the ring, so the chunk's signals are one gather into consecutive slots.
+            slot = self.ring.slot(self.ring_offset + self.oindex + len(self.output_buffer))
+            self.signal_ring.array[slot:slot + len(ds)] = mix_signals(self.signal_matrix[self.signal_rows[idx]], mix)
+            self.class_ring.array[slot:slot + len(ds)] = self.class_ids[idx]
+            for k, image_path in enumerate(ds):
+                if self.shards is not None:
+                    image_path = self.shards.file_paths[image_path]
+                d = dict()
+                d["image_path"] = image_path
+                d["file_path"] = image_path
+                d["image"] = self.ring.array[slot + k]
+                d["signals"] = self.signal_ring.array[slot + k]
+                d["points_table"] = None
+                self.output_buffer.append(d)
+            self.fill_stream()
+        buf = self.output_buffer[0:batch_size]
+        self.output_buffer = self.output_buffer[batch_size:]
+        self.oindex += len(buf)
+        self.fill_stream()
+        return buf
+
+    def export_shards(self, path, format="raw", quality=95, shard_bytes=SHARD_BYTES):
+        # Packs every indexed file, resized to target_size, into shards for shard_path=path.
+        # Files are written once in index order. data_align and shuffle are applied by the reader.
+        if self.index is None: raise Exception("export_shards needs an entry directory, not shard_path.")
+        writer = ShardWriter(path, (self.target_size[1], self.target_size[0], self.target_size[2]), format, quality, shard_bytes)
+        paths = self.index.paths()
+        signals = self.index.dir_signals(self.classes, self.make_signal)[self.index.file_dirs]
+        chunks = [paths[i:i + self.STREAM_BATCH] for i in range(0, len(paths), self.STREAM_BATCH)]
+        window = max(1, self.workers) * 4
+        futures = [self.submit(_load_resized, c, self.target_size, self.interpolation) for c in chunks[0:window]]
+        i = 0
+        for n in range(len(chunks)):
+            images = futures[n].result()
+            futures[n] = None
+            if n + window < len(chunks):
+                futures.append(self.submit(_load_resized, chunks[n + window], self.target_size, self.interpolation))
+            for img in images:
+                writer.write(img, signals[i], paths[i])
+                i += 1
+        writer.close(self.classes)
+        return path
 
     def find_index(self, class_dict):
         index = 0
@@ -348,13 +671,13 @@ class AggressiveImageGenerator:
         if self.verbose:
             print(loss)
         if loss == "list":
-            class_names = [os.path.basename(f) for f in glob.glob(os.path.join(entry, "*")) if os.path.isdir(f)]
+            class_names = [d for d in self.index.dirs if d and os.sep not in d]
             # print(class_names)
             for class_name in class_names:
                 self.register_class(class_name, class_dict, "S")
         elif loss == "tree":
-            for filename in pathlib.Path(entry).glob('**/'):
-                filename = str(filename)
+            for d in self.index.dirs:
+                filename = os.path.join(entry, d) if d else entry
                 # {}Attributs/{@}Target/{!}Ignore/{?}Unsupervised
                 if "/!" in filename:
                     print("Ignore", filename)
@@ -446,5 +769,6 @@ class AggressiveImageGenerator:
         return d.d
 
     @staticmethod
-    def set_max_cache_size(size):
-        pass
+    def set_max_cache_size(size, spill_path=None, spill_bytes=0):
+        # Decoded, target-size images are kept under an LRU byte budget, so later epochs skip decode.
+        image_cache.set_max_cache_size(size, spill_path, spill_bytes)
@@ -3,13 +3,156 @@ _dopen = open
 from aimage.ui import *
 from aimage.img import *
 from aimage.head import *
+from aimage import image_cache
+from aimage.image_cache import ImageCache, cache_meta, cache_slot, submit_after
+from aimage.img import _REDUCED_COLOR_FLAGS, _from_bgr, _reduced_decode_flag, _thread_pool
+from aimage.probe import probe_buffer
+from aimage.shared_batch import Batch, SampleRing, collate
+from aimage.loader_stats import LoaderStats, clock, mark
+from aimage.annotation_index import AnnotationIndex
+import asyncio
+import concurrent.futures
+import os
 import random
-import time
+
+import cv2
+import numpy as np
+
+_REDUCED_FACTORS = {flag: f for f, flag in _REDUCED_COLOR_FLAGS}
+
+
+def _load_od_stream(ds, color_order, profile):
+    # Stub of the native async loader. Runs on the shared thread pool (imread releases the GIL).
+    #    {
+    #      params:{
+    #          data_aug_params:{}
+    #      },
+    #      stream: [{image_path:"",signals:[],points_table:[]},{},{},{},]
+    #    }
+    spans = [] if profile else None
+    t = clock(spans)
+    stream = list()
+    for d in ds:
+        dd = dict()
+        dd["image_path"] = d["file_path"]
+        dd["image"] = load(d["file_path"], color_order=color_order)
+        dd["bounding_box_table"] = d["bounding_box_table"] if "bounding_box_table" in d else {}
+        stream.append(dd)
+        # imread reads and decodes in one call.
+        t = mark(spans, "load", t)
+    return stream, spans
+
+
+def _class_id(classes, name):
+    if isinstance(classes, dict):
+        c = classes[name]
+        return c["index"] if isinstance(c, dict) else c
+    return list(classes).index(name)
+
+
+def _box_rows(table, classes):
+    # bounding_box_table -> (K, 5) float32 rows of [x1, y1, x2, y2, class_id] in source image pixels.
+    # Accepts {class_name: [[x1, y1, x2, y2] or [[x1, y1], [x2, y2]], ...]} or rows of [x1, y1, x2, y2, class_id].
+    if table is None or len(table) == 0:
+        return np.zeros((0, 5), dtype=np.float32)
+    if isinstance(table, dict):
+        rows = []
+        for name in table:
+            cid = _class_id(classes, name)
+            for box in table[name]:
+                b = np.asarray(box, dtype=np.float32).reshape(-1)
+                rows.append((b[0], b[1], b[2], b[3], cid))
+        return np.array(rows, dtype=np.float32).reshape(-1, 5)
+    return np.asarray(table, dtype=np.float32).reshape(-1, 5)
+
+
+def _load_od_letterbox(tasks, color_order, classes, rings, slot, pad_value, interpolation, cache, profile):
+    # Letterbox mode: every sample is decoded (JPEG at the smallest DCT scale that still fills the box),
+    # letterboxed into its ring slot and its boxes are remapped with the same scale and offset.
+    # tasks: [(sample, cached location to copy from, cache location to fill)]. The cache keeps the
+    # letterboxed image and its (scale, offset), the boxes are always remapped from the sample.
+    images, boxes, counts, scales, offsets = rings
+    size = (images.shape[2], images.shape[1])
+    spans = [] if profile else None
+    t = clock(spans)
+    for k, (d, src, dst) in enumerate(tasks):
+        i = slot + k
+        if src is not None:
+            images[i] = cache_slot(cache, src)
+            meta = cache_meta(cache, src)
+            scale = meta[0:2].copy()
+            offset = meta[2:4].copy()
+            t = mark(spans, "cache", t)
+            _letterbox_boxes(d, classes, boxes, counts, scales, offsets, i, scale, offset)
+            continue
+        nb = np.fromfile(d["file_path"], dtype=np.uint8)
+        t = mark(spans, "read", t)
+        flag = _reduced_decode_flag(nb, max_side=max(size))
+        img = _from_bgr(cv2.imdecode(nb, flag), color_order)
+        if img is None:
+            raise Exception("Invalid image file or invalid path. \"%s\"" % (d["file_path"], ))
+        t = mark(spans, "decode", t)
+        # Boxes are in source pixels, so undo the DCT reduction (the header has the exact source size).
+        ih, iw = img.shape[0:2]
+        f = _REDUCED_FACTORS.get(flag, 1)
+        sw, sh = iw * f, ih * f
+        if f > 1:
+            head = probe_buffer(nb)
+            if head is not None and abs(head["width"] - sw) < f and abs(head["height"] - sh) < f:
+                sw, sh = head["width"], head["height"]
+        out, scale, offset = resize_batch([img], size, mode="letterbox", interpolation=interpolation, out=images[i:i + 1], workers=1, pad_value=pad_value)
+        scale = scale[0] * np.array((iw / sw, ih / sh), dtype=np.float32)
+        offset = offset[0]
+        if dst is not None:
+            cache_slot(cache, dst)[...] = images[i]
+            cache_meta(cache, dst)[...] = np.concatenate((scale, offset))
+        _letterbox_boxes(d, classes, boxes, counts, scales, offsets, i, scale, offset)
+        t = mark(spans, "resize", t)
+    return None, spans
+
+
+def _letterbox_boxes(d, classes, boxes, counts, scales, offsets, i, scale, offset):
+    rows = _box_rows(d.get("bounding_box_table"), classes)
+    n = min(len(rows), boxes.shape[1])
+    boxes[i] = 0
+    boxes[i, 0:n, 0:4] = rows[0:n, 0:4] * np.tile(scale, 2) + np.tile(offset, 2)
+    boxes[i, 0:n, 4] = rows[0:n, 4]
+    counts[i] = n
+    scales[i] = scale
+    offsets[i] = offset
 
 
 class AggressiveImageGeneratorForOD:
-    def __init__(self, datas, classes, data_aug_params, shuffle=True):
+    def __init__(self, datas, classes, data_aug_params, shuffle=True, color_order=None, workers=None, prefetch=None, batch_size=16, stats=False, trace=False, target_size=None, max_boxes=100, pad_value=0, overlap_epochs=True):
+        # datas: list of {"file_path", "bounding_box_table"}, or an AnnotationIndex (or its path) compiled by
+        #        compile_coco() / compile_voc(). classes=None then takes the index's classes.
+        # workers: loader threads (None: os.cpu_count()). batch_size is used by async iteration and get_batch().
+        # stats / trace: stage timers (get_stats()) and Chrome trace events (export_trace()).
+        # target_size: (w, h) enables letterbox mode, see get_batch(). Boxes beyond max_boxes per image are dropped.
+        # prefetch: samples loaded ahead. Default 1024, or 4 batches in letterbox mode (the ring holds prefetch + batch_size images).
+        # overlap_epochs: once the epoch is submitted, the next (reshuffled) epoch starts loading behind it, see sync_reset().
+        # set_max_cache_size() caches the letterboxed images, so it needs target_size.
+        if isinstance(datas, str):
+            datas = AnnotationIndex(datas)
+        self.annotations = None
+        if isinstance(datas, AnnotationIndex):
+            # Only the sample order lives in Python, samples are built per chunk from the memory maps.
+            self.annotations = datas
+            datas = np.arange(len(datas), dtype=np.int64)
+            if classes is None:
+                classes = self.annotations.classes
         self.classes = classes
+        self.color_order = color_order
+        self.workers = workers
+        self.target_size = target_size
+        self.max_boxes = max_boxes
+        self.pad_value = pad_value
+        if prefetch is None:
+            prefetch = 1024 if target_size is None else 4 * batch_size
+        self.prefetch = prefetch
+        self.batch_size = batch_size
+        self.ring = None
+        self.ring_offset = 0
         self.total = len(datas)
         self.q = 0
         self.iindex = 0
@@ -17,77 +160,230 @@ class AggressiveImageGeneratorForOD:
         self.datas = datas
         self.STREAM_BATCH = 16
         self.data_aug_params = data_aug_params
+        self.interpolation = interpolation_flag(data_aug_params.get("resize_interpolation", "fastest") if data_aug_params else "fastest")
         self.output_buffer = []
         self.shuffle = shuffle
-        self.stub_buffer = []
+        self.pending_streams = []
+        self.cache = None
+        self.overlap_epochs = overlap_epochs
+        self.next_epoch = None
+        self.loader_stats = LoaderStats(trace) if stats or trace else None
+
+    def fill_stream(self):
+        if self.target_size is not None:
+            return self.fill_ring()
+        if image_cache.max_cache_size > 0 and self.cache is None:
+            # Full size images are not cached. Warn once instead of ignoring the budget silently.
+            self.cache = False
+            print(CRED, "set_max_cache_size() is ignored without target_size (letterbox mode).", CRESET)
+        while self.q < self.prefetch and self.iindex < self.total:
+            ds = self.chunk(self.datas, self.iindex, self.iindex + self.STREAM_BATCH)
+            self.pending_streams.append(self.submit_chunk(ds, None))
+            self.iindex += len(ds)
+        if self.overlap_epochs and self.iindex == self.total and self.q < self.prefetch:
+            n = self.prepare_next_epoch()
+            while self.q < self.prefetch and n["iindex"] < len(n["datas"]):
+                ds = self.chunk(n["datas"], n["iindex"], n["iindex"] + self.STREAM_BATCH)
+                n["pending"].append(self.submit_chunk(ds, None))
+                n["iindex"] += len(ds)
+
+    def prepare_next_epoch(self):
+        if self.next_epoch is None:
+            self.next_epoch = {"datas": self.next_order(), "pending": [], "iindex": 0}
+        return self.next_epoch
+
+    def next_order(self):
+        # Sample order of the next epoch. A reshuffled copy, the current order is still being loaded.
+        if not self.shuffle:
+            return self.datas
+        if self.annotations is not None:
+            return np.random.default_rng(random.getrandbits(64)).permutation(self.datas)
+        datas = list(self.datas)
+        random.shuffle(datas)
+        return datas
+
+    def chunk(self, datas, start, stop):
+        if self.annotations is None:
+            return datas[start:stop]
+        return [self.annotations.sample(i) for i in datas[start:stop].tolist()]
+
+    def submit_chunk(self, ds, slot):
+        # slot None loads dicts, otherwise letterboxes into the rings from slot on. Returns (ds, future, cache keys).
+        self.q += len(ds)
+        submit = _thread_pool(self.workers).submit
+        if slot is None:
+            return (ds, submit(_load_od_stream, ds, self.color_order, self.loader_stats is not None), [])
+        rings = (self.ring.array, self.box_ring.array, self.count_ring.array, self.scale_ring.array, self.offset_ring.array)
+        if not self.cache:
+            tasks = [(d, None, None) for d in ds]
+            return (ds, submit(_load_od_letterbox, tasks, self.color_order, self.classes, rings, slot, self.pad_value, self.interpolation, None, self.loader_stats is not None), [])
+        tasks, keys, waits = self.cache.acquire_tasks(ds, [self.cache_key(d) for d in ds])
+        future = submit_after(submit, waits, tasks, _load_od_letterbox, tasks, self.color_order, self.classes, rings, slot, self.pad_value, self.interpolation, self.cache.handle(), self.loader_stats is not None)
+        self.cache.submitted(keys, future)
+        return (ds, future, keys)
+
+    def cache_key(self, d):
+        try:
+            st = os.stat(d["file_path"])
+        except OSError:
+            # The loader reports the missing file.
+            return None
+        return (d["file_path"], st.st_mtime_ns, st.st_size, (int(self.target_size[0]), int(self.target_size[1])))
+
+    def release_cache(self, future, keys):
+        if self.cache and len(keys) > 0:
+            self.cache.release(keys, ok=future.cancelled() is False and future.exception() is None)
+
+    def build_ring(self):
+        # Sample rings indexed by stream position, like AggressiveImageGenerator. A batch is a slice of them.
+        bs = self.batch_size
+        slots = (self.prefetch + bs + bs - 1) // bs * bs
+        w, h = int(self.target_size[0]), int(self.target_size[1])
+        self.ring = SampleRing(slots, (h, w, 3), np.uint8)
+        self.box_ring = SampleRing(slots, (self.max_boxes, 5), np.float32)
+        self.count_ring = SampleRing(slots, (), np.int32)
+        self.scale_ring = SampleRing(slots, (2, ), np.float32)
+        self.offset_ring = SampleRing(slots, (2, ), np.float32)
+        self.ring_offset = 0
+        self.cache = ImageCache.create((h, w, 3), meta_size=4)
+
+    def fill_ring(self):
+        if self.ring is None:
+            self.build_ring()
+        limit = self.ring.slots - self.batch_size
+        while self.iindex - self.oindex < limit and self.iindex < self.total:
+            slot = self.ring.slot(self.ring_offset + self.iindex)
+            dlen = min(self.STREAM_BATCH, self.total - self.iindex, self.ring.slots - slot, limit - (self.iindex - self.oindex))
+            self.pending_streams.append(self.submit_chunk(self.chunk(self.datas, self.iindex, self.iindex + dlen), slot))
+            self.iindex += dlen
+        if self.overlap_epochs and self.iindex == self.total and self.iindex - self.oindex < limit:
+            # The next epoch continues the stream right after this one in the rings.
+            n = self.prepare_next_epoch()
+            ahead = self.total - self.oindex
+            total = len(n["datas"])
+            while ahead + n["iindex"] < limit and n["iindex"] < total:
+                slot = self.ring.slot(self.ring_offset + self.total + n["iindex"])
+                dlen = min(self.STREAM_BATCH, total - n["iindex"], self.ring.slots - slot, limit - (ahead + n["iindex"]))
+                n["pending"].append(self.submit_chunk(self.chunk(n["datas"], n["iindex"], n["iindex"] + dlen), slot))
+                n["iindex"] += dlen
 
     def get_data_block(self, batch_size):
         if self.total == 0:
-            raise "Zero length"
-        while True:
-            if self.q < 1024:
-                if self.iindex < self.total:
-                    ds = self.datas[self.iindex:self.iindex + self.STREAM_BATCH]
-                    dlen = len(ds)
-                    self.q += dlen
-                    stream = list()
-                    #input   = dict()
-                    #input["data_aug_params"] = self.data_aug_params
-                    for d in ds:
-                        dd = dict()
-                        dd["image_path"] = d["file_path"]
-                        dd["image"] = load(d["file_path"])
-                        dd["points_table"] = d["bounding_box_table"]
-                        stream.append(dd)
-                    #input["stream"] = stream
-                    # //    {
-                    # //      params:{
-                    # //          data_aug_params:{}
-                    # //      },
-                    # //      stream: [{image_path:"",signals:[],points_table:[]},{},{},{},]
-                    # //    }
-                    # native_module.async_image_loader_with_data_aug_input(str(hex(id(self))),input)
-                    self.stub_buffer += stream
-                    #self.stub_buffer += [input]
-                    # native_module.image_data_augmentation(input)
-                    self.iindex += dlen
-                else:
-                    # random.shuffle(self.datas)
-                    # self.iindex = 0
-                    break
-            else:
-                break
-
+            raise Exception("Zero length")
+        if self.target_size is not None and batch_size > self.batch_size:
+            raise Exception("batch_size(%d) must be <= the generator batch_size(%d)." % (batch_size, self.batch_size))
+        t0 = clock([] if self.loader_stats else None)
+        self.fill_stream()
         if self.iindex == self.oindex:
             return None
-        if len(self.output_buffer) >= batch_size or self.iindex == self.oindex + len(self.output_buffer):
-            buf = self.output_buffer[0:batch_size]
-            self.output_buffer = self.output_buffer[batch_size:]
-            self.oindex += len(buf)
-            return buf
-        while True:
-            #ret = native_module.async_image_loader_with_data_aug_output(str(hex(id(self))))
-            ret = self.stub_buffer
-            if ret is not None and len(ret) > 0:
-                for d in ret:
-                    if "points_table" in d:
-                        points_table = d["points_table"]
-                        del d["points_table"]
-                        d["bounding_box_table"] = points_table
-                    else:
-                        d["bounding_box_table"] = {}
-                self.q -= len(ret)
-                self.output_buffer += ret
-                self.stub_buffer = []
-                if len(self.output_buffer) >= batch_size or self.iindex == self.oindex + len(self.output_buffer):
-                    buf = self.output_buffer[0:batch_size]
-                    self.output_buffer = self.output_buffer[batch_size:]
-                    self.oindex += len(buf)
-                    return buf
-            else:
-                time.sleep(0.1)
-                if self.iindex == self.oindex:
-                    return None
+        while len(self.output_buffer) < batch_size and self.iindex != self.oindex + len(self.output_buffer):
+            # Blocks on the oldest chunk until a loader thread completes it, no polling.
+            ds, future, keys = self.pending_streams.pop(0)
+            t = clock([] if self.loader_stats else None)
+            concurrent.futures.wait([future])
+            self.release_cache(future, keys)
+            stream, spans = future.result()
+            if self.loader_stats:
+                self.loader_stats.add("wait", t)
+                self.loader_stats.add_spans(spans)
+            if stream is None:
+                # Letterbox mode: the samples are in the rings.
+                slot = self.ring.slot(self.ring_offset + self.oindex + len(self.output_buffer))
+                stream = []
+                for k, d in enumerate(ds):
+                    dd = dict()
+                    dd["image_path"] = d["file_path"]
+                    dd["image"] = self.ring.array[slot + k]
+                    dd["boxes"] = self.box_ring.array[slot + k, 0:self.count_ring.array[slot + k]]
+                    dd["bounding_box_table"] = d["bounding_box_table"] if "bounding_box_table" in d else {}
+                    stream.append(dd)
+            self.output_buffer += stream
+            self.q -= len(ds)
+            self.fill_stream()
+        buf = self.output_buffer[0:batch_size]
+        self.output_buffer = self.output_buffer[batch_size:]
+        self.oindex += len(buf)
+        self.fill_stream()
+        if self.loader_stats:
+            self.loader_stats.batch(t0, len(buf), self.q, len(self.output_buffer))
+        return buf
+
+    def get_stats(self):
+        # Same layout as AggressiveImageGenerator.get_stats(). Stages: load, or read, decode, resize and cache in letterbox mode (workers), wait (consumer).
+        if self.loader_stats is None: raise Exception("Create the generator with stats=True.")
+        return self.loader_stats.summary()
+
+    def export_trace(self, path):
+        if self.loader_stats is None or self.loader_stats.trace is False: raise Exception("Create the generator with trace=True.")
+        return self.loader_stats.export_trace(path)
+
+    def get_batch(self, batch_size=None, layout="nhwc", dtype="uint8"):
+        # Letterbox mode. Returns None at the end of the epoch, otherwise a Batch (exports images through __dlpack__ and the buffer protocol):
+        #  - images: (B, h, w, 3) uint8, a view of the ring that stays valid until the next batch.
+        #            Other layout ("nchw") / dtype are collated into a new array, pixel values are not rescaled.
+        #  - boxes: (B, max_boxes, 5) float32 [x1, y1, x2, y2, class_id] in letterboxed pixels, zero padded.
+        #  - counts: (B, ) int32 valid boxes per image.
+        #  - scales / offsets: (B, 2) float32 (x, y), letterboxed_xy = source_xy * scale + offset.
+        if self.target_size is None: raise Exception("get_batch needs target_size (letterbox mode).")
+        if batch_size is None:
+            batch_size = self.batch_size
+        block = self.get_data_block(batch_size)
+        if block is None:
+            return None
+        position = self.ring_offset + self.oindex - len(block)
+        b = Batch()
+        b.images = collate(self.ring.take(position, len(block)), layout, dtype)
+        b.boxes = np.array(self.box_ring.take(position, len(block)))
+        b.counts = np.array(self.count_ring.take(position, len(block)))
+        b.scales = np.array(self.scale_ring.take(position, len(block)))
+        b.offsets = np.array(self.offset_ring.take(position, len(block)))
+        b.file_paths = [d["image_path"] for d in block]
+        return b
+
+    def next_futures(self, batch_size):
+        # Chunks the next get_data_block(batch_size) would wait for.
+        self.fill_stream()
+        need = batch_size - len(self.output_buffer)
+        futures = []
+        for ds, future, keys in self.pending_streams:
+            if need <= 0:
+                break
+            futures.append(future)
+            need -= len(ds)
+        return futures
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        # Awaits the loader threads without blocking the event loop. Ends (and reshuffles) after an epoch.
+        if self.total > 0:
+            for future in self.next_futures(self.batch_size):
+                await asyncio.wrap_future(future)
+        buf = self.get_data_block(self.batch_size) if self.target_size is None else self.get_batch(self.batch_size)
+        if buf is None:
+            self.sync_reset()
+            raise StopAsyncIteration()
+        return buf
+
+    def close(self):
+        # Frees the image cache (and its spill file).
+        self.drain()
+        if self.cache:
+            self.cache.close()
+        self.cache = None
+
+    def drain(self):
+        pending = self.pending_streams + (self.next_epoch["pending"] if self.next_epoch is not None else [])
+        for ds, future, keys in pending:
+            future.cancel()
+        concurrent.futures.wait([future for ds, future, keys in pending])
+        for ds, future, keys in pending:
+            self.release_cache(future, keys)
+        self.pending_streams = []
+        self.next_epoch = None
+        self.output_buffer = []
+        self.q = 0
 
     @staticmethod
     def make_full_aug_params():
@@ -137,11 +433,26 @@ class AggressiveImageGeneratorForOD:
         return d.d
 
     def sync_reset(self):
-        if self.shuffle:
-            random.shuffle(self.datas)
+        n = self.next_epoch
+        if n is not None and self.oindex == self.total and len(self.output_buffer) == 0:
+            # The epoch was consumed to the end, continue with the next one already loading behind it.
+            self.ring_offset += self.total
+            self.datas = n["datas"]
+            self.pending_streams = n["pending"]
+            self.next_epoch = None
+            self.total = len(self.datas)
+            self.iindex = n["iindex"]
+            self.oindex = 0
+            return
+        self.drain()
+        self.ring_offset += self.oindex
+        self.datas = self.next_order()
+        self.total = len(self.datas)
         self.iindex = 0
         self.oindex = 0
 
     @staticmethod
-    def set_max_cache_size(size):
-        pass
+    def set_max_cache_size(size, spill_path=None, spill_bytes=0):
+        # Letterboxed images (target_size) are kept under an LRU byte budget, keyed by (path, mtime, size, target_size).
+        # Applies to generators whose rings are built after the call.
+        image_cache.set_max_cache_size(size, spill_path, spill_bytes)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+import concurrent.futures
+import tempfile
+
+from aimage.image_cache import ImageCache, cache_slot, submit_after
+
+SHAPE = (4, 4, 3)
+SLOT = 4 * 4 * 3
+
+
+def fill(cache, key, value):
+    state, loc = cache.acquire(key)
+    assert state == "fill"
+    cache_slot(cache.handle(), loc)[...] = value
+    return loc
+
+
+def test_pinned_entries_are_not_evicted():
+    cache = ImageCache(SHAPE, 2 * SLOT)
+    a = fill(cache, "a", 1)
+    b = fill(cache, "b", 2)
+    # Both slots are pinned by their queued fills: nothing can be evicted.
+    assert cache.acquire("c") == ("load", None)
+    cache.release([("a", True), ("b", True)])
+    assert cache.acquire("a") == ("hit", a)
+    # "a" is pinned by the hit, so "c" takes the slot of "b".
+    assert cache.acquire("c") == ("fill", b)
+    assert cache.find("a") is not None and cache.find("b") is None
+    assert cache_slot(cache.handle(), a)[0, 0, 0] == 1
+    cache.release([("a", False), ("c", True)])
+    cache.close()
+
+
+def test_eviction_spills_to_disk():
+    with tempfile.TemporaryDirectory() as d:
+        cache = ImageCache(SHAPE, SLOT, d, 2 * SLOT)
+        fill(cache, "a", 1)
+        cache.release([("a", True)])
+        fill(cache, "b", 2)
+        cache.release([("b", True)])
+        state, loc = cache.acquire("a")
+        assert state == "hit" and loc[0] == ImageCache.DISK
+        assert cache_slot(cache.handle(), loc)[0, 0, 0] == 1
+        cache.release([("a", False)])
+        cache.close()
+
+
+def test_failed_fill_is_dropped():
+    cache = ImageCache(SHAPE, SLOT)
+    fill(cache, "a", 1)
+    cache.release([("a", True)], ok=False)
+    assert cache.find("a") is None
+    assert cache.acquire("a")[0] == "fill"
+    cache.close()
+
+
+def test_wait_copies_after_the_fill():
+    cache = ImageCache(SHAPE, 2 * SLOT)
+    fill(cache, "a", 1)
+    future = concurrent.futures.Future()
+    cache.submitted([("a", True)], future)
+    tasks, held, waits = cache.acquire_tasks(["pa"], ["a"])
+    assert held == [("a", False)] and waits == [(0, future)]
+    with concurrent.futures.ThreadPoolExecutor(1) as executor:
+        waiting = submit_after(executor.submit, waits, tasks, lambda t: list(t), tasks)
+        assert waiting.done() is False
+        future.set_running_or_notify_cancel()
+        future.set_result(None)
+        assert waiting.result()[0][1] is not None
+        # A failed fill turns the waiting task into a plain load.
+        failed = concurrent.futures.Future()
+        failed.set_running_or_notify_cancel()
+        failed.set_exception(ValueError())
+        tasks = [("pa", (0, 0), None)]
+        assert submit_after(executor.submit, [(0, failed)], tasks, lambda t: list(t), tasks).result() == [("pa", None, None)]
+    cache.close()
+
+
+if __name__ == "__main__":
+    test_pinned_entries_are_not_evicted()
+    test_eviction_spills_to_disk()
+    test_failed_fill_is_dropped()
+    test_wait_copies_after_the_fill()
+    print("Done")
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+
+import cv2
+import numpy as np
+from aimage.probe import probe_buffer, probe_file
+
+CASES = [
+    (".jpg", []),
+    (".jpg", [cv2.IMWRITE_JPEG_PROGRESSIVE, 1]),
+    (".png", []),
+    (".gif", []),
+    (".tiff", []),
+    (".webp", [cv2.IMWRITE_WEBP_QUALITY, 80]),
+    (".webp", [cv2.IMWRITE_WEBP_QUALITY, 101]),
+]
+
+
+def test_probe_matches_imread():
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as d:
+        for w, h in ((53, 37), (1, 1), (640, 17)):
+            for channels in (1, 3, 4):
+                img = rng.integers(0, 255, (h, w, channels), dtype=np.uint8)
+                for ext, params in CASES:
+                    path = os.path.join(d, "image" + ext)
+                    if not cv2.imwrite(path, img, params):
+                        continue
+                    ref = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+                    if ref is None:
+                        continue
+                    head = probe_file(path)
+                    assert head is not None, (ext, params, w, h, channels)
+                    assert (head["width"], head["height"]) == (ref.shape[1], ref.shape[0]), (ext, params, head, ref.shape)
+                    assert probe_buffer(np.fromfile(path, dtype=np.uint8)) == head
+
+
+def test_probe_rejects_unknown_data():
+    assert probe_buffer(b"not an image") is None
+    assert probe_buffer(b"\xff\xd8\xff") is None
+
+
+if __name__ == "__main__":
+    test_probe_matches_imread()
+    test_probe_rejects_unknown_data()
+    print("Done")
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+import numpy as np
+from aimage.sampler import BalancedSampler, LazyPermutation
+
+
+def old_data_align(items, keys, data_align):
+    # The list the generator built before BalancedSampler: classes in first appearance order,
+    # each stretched by repeating its samples.
+    table = {}
+    for item, key in zip(items, keys):
+        table.setdefault(key, []).append(item)
+    vmax = max(len(v) for v in table.values())
+    datas = []
+    for v in table.values():
+        tlen = len(v) + int((vmax - len(v)) * data_align)
+        datas += [v[x % len(v)] for x in range(tlen)]
+    return datas
+
+
+def test_permutation_is_bijection():
+    for n in (1, 2, 3, 7, 64, 100, 1000, 4097):
+        for seed in (0, 1, [3, 5]):
+            p = LazyPermutation(n, seed)(np.arange(n))
+            assert sorted(p.tolist()) == list(range(n))
+
+
+def test_permutation_depends_on_seed():
+    a = LazyPermutation(1000, 0)(np.arange(1000))
+    b = LazyPermutation(1000, 1)(np.arange(1000))
+    assert not np.array_equal(a, b)
+    assert np.array_equal(a, LazyPermutation(1000, 0)(np.arange(1000)))
+
+
+def test_sample_index_matches_data_align_list():
+    rng = np.random.default_rng(0)
+    keys = rng.integers(0, 5, 200)
+    keys[0:3] = [3, 0, 3]
+    items = ["s%d" % i for i in range(len(keys))]
+    for data_align in (0.1, 0.25, 0.5, 0.99, 1.0):
+        sampler = BalancedSampler(items, keys, data_align)
+        old = old_data_align(items, keys.tolist(), data_align)
+        assert len(sampler) == len(old)
+        assert [items[i] for i in sampler.sample_index(np.arange(len(sampler))).tolist()] == old
+        assert sampler.epoch()[:] == old
+
+
+def test_epoch_ranks_are_disjoint():
+    items = list(range(103))
+    sampler = BalancedSampler(items, np.zeros(len(items)), 0)
+    seen = []
+    for rank in range(4):
+        view = sampler.epoch(7, rank, 4)
+        assert len(view) == len(items) // 4
+        seen += view[:]
+    assert len(set(seen)) == len(seen)
+
+
+if __name__ == "__main__":
+    test_permutation_is_bijection()
+    test_permutation_depends_on_seed()
+    test_sample_index_matches_data_align_list()
+    test_epoch_ranks_are_disjoint()
+    print("Done")